@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+""" Benchmark doit2todoist end to end, from parsing to committing to Todoist.
+
+Synthetic Doit exports of different sizes are generated, see doit_generator.py,
+and exported to a Todoist account emulated in the same process, see
+todoist_server.py, so only this script's own work is measured. Each size is
+measured in a fresh process, to get its own peak memory usage.
+
+The results are appended to a JSON lines file, and compared with the last
+results for the same parameters, so regressions are easy to spot. The parsing
+is also compared with reading all of the file at once, the way it was done
+before it was streamed:
+
+    python benchmark.py --sizes 1000,10000
+    ...change something...
+    python benchmark.py --sizes 1000,10000
+
+"""
+
+import sys
+import os
+import json
+import time
+import shutil
+import argparse
+import resource
+import platform
+import tempfile
+import subprocess
+
+import doit2todoist
+import doit_generator
+import todoist_server
+
+# The metrics that are compared between runs, and if higher is better
+compared = (('parse_seconds', False), ('plan_seconds', False),
+            ('apply_seconds', False), ('peak_rss_kb', False),
+            ('commands_per_commit', True), ('tasks_per_second', True))
+
+
+class LocalTodoistAPI(doit2todoist.TodoistHelperAPI):
+    """Talks to an emulated Todoist account in the same process.
+
+    The requests and responses are still JSON encoded and decoded, as they
+    would be over HTTP.
+
+    """
+
+    def __init__(self, token, account, **kwargs):
+        self.account = account
+        super(LocalTodoistAPI, self).__init__(token, **kwargs)
+
+    def _post(self, call, url=None, **kwargs):
+        data = kwargs.get('data') or {}
+        response = self.account.sync(data.get('sync_token'),
+                                     json.loads(data.get('commands') or '[]'))
+        return json.loads(json.dumps(response))
+
+
+def peak_rss():
+    """Return the peak memory usage of this process, in KB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # In bytes on Mac
+        rss //= 1024
+    return rss
+
+
+def measure(doit_file, seed_file=None, batch_size=None):
+    """Export a Doit file to an emulated account, and time each phase.
+
+    :rtype: dict
+    :return: The metrics.
+
+    """
+    result = {}
+    workdir = tempfile.mkdtemp(prefix='doit2todoist-bench-')
+    start = time.time()
+    try:
+        doit = doit2todoist.load_doit_file(doit_file)
+        result['parse_seconds'] = time.time() - start
+        result['parse_rss_kb'] = peak_rss()
+
+        seed = None
+        if seed_file:
+            with open(seed_file) as f:
+                seed = json.load(f)
+        api = LocalTodoistAPI('benchmark', todoist_server.Account('benchmark',
+                                                                  seed),
+                              batch_size=batch_size,
+                              limiter=doit2todoist.RateLimiter(10 ** 9))
+        stats = {'commits': 0, 'commands': 0}
+
+        def count(commands):
+            stats['commits'] += 1
+            stats['commands'] += len(commands)
+        api.send_listeners.append(count)
+
+        t = time.time()
+        api.sync()
+        result['sync_seconds'] = time.time() - t
+
+        idmap = doit2todoist.IdentityMap(os.path.join(workdir, 'idmap.db'))
+        exp = doit2todoist.Todoist_exporter(doit, api, idmap)
+        # The exporter prints every task
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            t = time.time()
+            plan = exp.plan()
+            result['plan_seconds'] = time.time() - t
+            result['planned_commands'] = plan.count_commands()
+            t = time.time()
+            exp.apply(plan)
+            result['apply_seconds'] = time.time() - t
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        idmap.close()
+        result['todoist_items'] = len(api.items.all())
+    finally:
+        shutil.rmtree(workdir)
+
+    total = time.time() - start
+    result['total_seconds'] = total
+    result['tasks'] = len(doit.tasks)
+    result['tasks_per_second'] = len(doit.tasks) / total if total else 0
+    result['commits'] = stats['commits']
+    result['commands'] = stats['commands']
+    result['commands_per_commit'] = (float(stats['commands']) /
+                                     stats['commits'] if stats['commits']
+                                     else 0)
+    result['peak_rss_kb'] = peak_rss()
+
+    # Parsed as before the streaming, reading all of the file at once. After
+    # the peak memory usage is taken, since all of it is then in memory.
+    t = time.time()
+    doit2todoist.Doit(doit2todoist.parse_json_file(doit_file))
+    result['baseline_parse_seconds'] = time.time() - t
+    return result
+
+
+def run(tasks, fmt, workdir, options):
+    """Generate an export and measure it in a fresh process."""
+    doit_file = os.path.join(workdir, 'doit-%d.%s' % (tasks, fmt))
+    seed_file = os.path.join(workdir, 'seed-%d.json' % tasks)
+    t = time.time()
+    data = doit_generator.generate(tasks, repeaters=options.repeaters,
+                                   notes=options.notes,
+                                   note_length=options.note_length)
+    doit_generator.write_export(data, doit_file, html=(fmt == 'html'))
+    with open(seed_file, 'w') as f:
+        json.dump(doit_generator.overlap_seed(data, options.overlap), f)
+    del data
+    generate_seconds = time.time() - t
+
+    cmd = [sys.executable, os.path.abspath(__file__), '--measure', doit_file,
+           '--seed-file', seed_file, '--batch-size', str(options.batch_size)]
+    output = subprocess.check_output(cmd)
+    result = json.loads(output.strip().splitlines()[-1])
+    result.update({'format': fmt, 'generate_seconds': generate_seconds,
+                   'file_bytes': os.path.getsize(doit_file)})
+    os.remove(doit_file)
+    os.remove(seed_file)
+    return result
+
+
+def git_revision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', '--short',
+                                            'HEAD'], stderr=devnull,
+                                           cwd=os.path.dirname(
+                                               os.path.abspath(__file__))
+                                           ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_results(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _same_parameters(a, b):
+    return all(a.get(k) == b.get(k) for k in ('tasks', 'format', 'overlap',
+                                              'batch_size', 'repeaters',
+                                              'notes', 'note_length'))
+
+
+def compare_baseline(result, threshold):
+    """Print if the parsing is slower than reading the file all at once."""
+    baseline = result.get('baseline_parse_seconds')
+    if not baseline:
+        return
+    change = (result['parse_seconds'] - baseline) / baseline
+    print "    parse vs all at once (%.2fs): %+.0f%%%s" % (
+        baseline, change * 100, ' REGRESSION' if change > threshold else '')
+
+
+def compare(result, previous, threshold):
+    """Print how the result differs from the last with the same parameters."""
+    old = [r for r in previous if _same_parameters(r, result)]
+    if not old:
+        return
+    old = old[-1]
+    changes = []
+    for metric, higher_is_better in compared:
+        if not old.get(metric) or metric not in result:
+            continue
+        change = (result[metric] - old[metric]) / float(old[metric])
+        worse = change < -threshold if higher_is_better else change > threshold
+        changes.append('%s %+.0f%%%s' % (metric, change * 100,
+                                         ' REGRESSION' if worse else ''))
+    print "    vs %s: %s" % (old.get('revision') or old['time'],
+                             ', '.join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark doit2todoist "
+                                                 "against an emulated Todoist")
+    parser.add_argument('--sizes', default='1000,10000,100000,1000000',
+                        help='Comma separated numbers of tasks. '
+                             'Default: %(default)s')
+    parser.add_argument('--formats', default='json,html',
+                        help='Comma separated export formats, json and/or '
+                             'html. Default: %(default)s')
+    parser.add_argument('--overlap', type=float, default=0.1,
+                        help='Share of the tasks that the account already has. '
+                             'Default: %(default)s')
+    parser.add_argument('--repeaters', type=float, default=0.05,
+                        help='Default: %(default)s')
+    parser.add_argument('--notes', type=float, default=0.3,
+                        help='Default: %(default)s')
+    parser.add_argument('--note-length', type=int, default=200,
+                        help='Default: %(default)s')
+    parser.add_argument('--batch-size', type=int,
+                        default=doit2todoist.TodoistHelperAPI.batch_size,
+                        help='Default: %(default)s')
+    parser.add_argument('--results', default='benchmark_results.jsonl',
+                        help='File to append the results to, and compare '
+                             'with. Default: %(default)s')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative change that counts as a regression. '
+                             'Default: %(default)s')
+    parser.add_argument('--workdir',
+                        help='Where to put the generated exports. Default: A '
+                             'temporary directory')
+    # For the measuring subprocess
+    parser.add_argument('--measure', metavar='FILE', help=argparse.SUPPRESS)
+    parser.add_argument('--seed-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    doit2todoist.setup_logger()
+    if args.measure:
+        print json.dumps(measure(args.measure, args.seed_file,
+                                 args.batch_size))
+        return 0
+
+    previous = load_results(args.results)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='doit2todoist-bench-')
+    meta = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'revision': git_revision(), 'python': platform.python_version(),
+            'host': platform.node(), 'overlap': args.overlap,
+            'batch_size': args.batch_size, 'repeaters': args.repeaters,
+            'notes': args.notes, 'note_length': args.note_length}
+    try:
+        for tasks in [int(n) for n in args.sizes.split(',')]:
+            for fmt in args.formats.split(','):
+                result = run(tasks, fmt, workdir, args)
+                result.update(meta)
+                print("%8d tasks (%s): parse %.2fs, plan %.2fs, apply %.2fs, "
+                      "%.0f tasks/s, %.1f commands/commit, peak RSS %d MB" %
+                      (tasks, fmt, result['parse_seconds'],
+                       result['plan_seconds'], result['apply_seconds'],
+                       result['tasks_per_second'],
+                       result['commands_per_commit'],
+                       result['peak_rss_kb'] // 1024))
+                compare_baseline(result, args.threshold)
+                compare(result, previous, args.threshold)
+                with open(args.results, 'a') as f:
+                    f.write(json.dumps(result, sort_keys=True) + '\n')
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,11 +2,29 @@
 """ Script for exporting Doit.im data into Todoist. """
 
 import sys
+import os
+import re
 import logging
 import argparse
 import time
+import threading
+import contextlib
+import atexit
+import Queue
+import random
+import mmap
+import hashlib
+import uuid
+import urllib
 from HTMLParser import HTMLParser
 import json
+import csv
+import math
+import bisect
+import calendar
+from array import array
+import sqlite3
+import multiprocessing
 
 import todoist
 
@@ -59,13 +77,422 @@ class SimpleHTMLParser(HTMLParser):
     def get_body(self):
         return ''.join(self.bodydata)
 
+def read_chunks(filename, size=1 << 20):
+    """Read a file in chunks of the given size."""
+    f = open(filename, 'rb')
+    try:
+        while True:
+            chunk = f.read(size)
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        f.close()
+
+def iter_json_file(filename):
+    """Iterate over the records in a file with Doit data.
+
+    :rtype: generator
+    :return: Tuples with the name of the list, e.g. 'tasks', and a record.
+
+    """
+    return StreamingJSONReader(read_chunks(filename)).records()
+
+_json_start = re.compile(r'\s*{')
+_body_start = re.compile(r'<body[^>]*>\s*', re.I)
+_body_end = re.compile(r'</body\s*>', re.I)
+
+def locate_json_payload(buf):
+    """Find where the JSON object starts, in JSON or HTML.
+
+    The search is done directly in the given buffer, e.g. a memory mapped file,
+    without copying or parsing the HTML.
+
+    :rtype: tuple
+    :return: The position of the JSON object's "{", and True if it's inside
+        the <body> of an HTML page.
+
+    :raise ValueError: If the data is not plain JSON nor a proper <body> with
+        the JSON object in it.
+
+    """
+    m = _json_start.match(buf)
+    if m:
+        return m.end() - 1, False
+    m = _body_start.search(buf)
+    if m is None:
+        raise ValueError("No <body> element found")
+    if buf[m.end():m.end() + 1] != '{':
+        raise ValueError("No JSON object found in <body>")
+    # The end is normally near the end of the page, so look there first
+    if (_body_end.search(buf, max(m.end(), len(buf) - (1 << 16))) is None and
+            _body_end.search(buf, m.end()) is None):
+        raise ValueError("No end of <body> found")
+    return m.end(), True
+
+def iter_mapped_file(filename):
+    """Iterate over the records in a file with Doit data, memory mapped.
+
+    The file is not read into memory, but mapped. The JSON object is located
+    by `locate_json_payload`, and the records are decoded from windows of the
+    mapped file, one by one.
+
+    :rtype: generator
+    :return: Tuples with the name of the list, e.g. 'tasks', and a record.
+
+    """
+    f = open(filename, 'rb')
+    try:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    try:
+        start, html = locate_json_payload(mm)
+        reader = StreamingJSONReader.from_buffer(mm, start, html=html)
+        for record in reader.records():
+            yield record
+    finally:
+        mm.close()
+
+class StreamingJSONReader:
+
+    """Read Doit data from chunks of JSON, one record at a time.
+
+    The Doit data is one JSON object with lists of records, like
+    `{"tasks": [...], "projects": [...]}`, either alone or as the content of a
+    <body> element in an HTML file. Instead of decoding all of it at once, the
+    lists' records are decoded one by one, so only the current record and a
+    chunk need to be kept in memory.
+
+    Each record is decoded by `json.JSONDecoder.raw_decode` straight from the
+    buffer, which also tells where the record ends. A record that continues in
+    the next chunk fails to decode, and is decoded again with more data. Only
+    the few characters between the records are looked at in Python.
+
+    The data could also be given as one buffer, e.g. a memory mapped file, see
+    `from_buffer`. It's then read in windows, as if it were chunks.
+
+    """
+
+    # What could come before a value, and between values in a list
+    _whitespace = re.compile(r'[ \t\r\n]*')
+    _separator = re.compile(r'[ \t\r\n,]*')
+
+    # Entities that a browser escapes when saving text in HTML
+    _html_entities = (('&lt;', '<'), ('&gt;', '>'), ('&amp;', '&'))
+
+    def __init__(self, chunks, html=False):
+        self._chunks = iter(chunks)
+        self.buf = ''
+        self.pos = 0
+        self.html = html
+        # The start of an entity at the end of the last chunk, if it's split
+        self._partial = ''
+        # Not strict, since newlines in strings are not escaped in Doit's data
+        self._decoder = json.JSONDecoder(strict=False)
+
+    @classmethod
+    def from_buffer(cls, buf, start=0, html=False, window=1 << 20):
+        """Read from a buffer, starting at the given position.
+
+        :param buf: Anything that could be sliced like a str, e.g. an
+            `mmap.mmap`.
+        :param int window: The number of characters to decode from at a time.
+
+        """
+        return cls((buf[i:i + window]
+                    for i in xrange(start, len(buf), window)), html=html)
+
+    def _unescape(self, text):
+        """Replace the HTML entities in the text.
+
+        An entity that is cut off at the end is kept for the next text.
+
+        """
+        text = self._partial + text
+        i = text.rfind('&', max(0, len(text) - 4))
+        if i >= 0 and ';' not in text[i:]:
+            self._partial = text[i:]
+            text = text[:i]
+        else:
+            self._partial = ''
+        for entity, char in self._html_entities:
+            text = text.replace(entity, char)
+        return text
+
+    def _more(self, keep):
+        """Read the next chunk into the buffer.
+
+        What's in the buffer before `keep` is dropped, and the number of dropped
+        characters is returned, for the caller to adjust its positions.
+
+        """
+        for chunk in self._chunks:
+            if self.html:
+                chunk = self._unescape(chunk)
+            if chunk:
+                break
+        else:
+            chunk, self._partial = self._partial, ''
+        if not chunk:
+            raise ValueError("Unexpected end of JSON data")
+        self.buf = self.buf[keep:] + chunk
+        self.pos -= keep
+        return keep
+
+    def _skip(self, pattern=_whitespace):
+        """Skip what the pattern matches and return the next character."""
+        while True:
+            self.pos = pattern.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            self._more(self.pos)
+
+    def _find(self, text):
+        """Move past the next occurrence of the given text."""
+        while True:
+            i = self.buf.find(text, self.pos)
+            if i >= 0:
+                self.pos = i + len(text)
+                return
+            self.pos = max(self.pos, len(self.buf) - len(text) + 1)
+            self._more(self.pos)
+
+    def _read_value(self):
+        """Decode the JSON value at the current position, and move past it."""
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buf, self.pos)
+            except ValueError, e:
+                # Probably cut off at the end of the buffer
+                try:
+                    self._more(self.pos)
+                except ValueError:
+                    raise e
+                continue
+            if end >= len(self.buf):
+                # A number or the like could continue in the next chunk
+                try:
+                    self._more(self.pos)
+                except ValueError:
+                    self.pos = end
+                    return value
+                continue
+            self.pos = end
+            return value
+
+    def _find_payload(self):
+        """Move to the start of the JSON object, skipping any HTML."""
+        c = self._skip()
+        if c == '<':
+            self.html = True
+            self._find('<body')
+            self._find('>')
+            self.buf = self._unescape(self.buf[self.pos:])
+            self.pos = 0
+            c = self._skip()
+        if c != '{':
+            raise ValueError("No JSON object found")
+
+    def records(self):
+        """Iterate over the records in the lists of the JSON object.
+
+        :rtype: generator
+        :return: Tuples with the name of the list and a record.
+
+        """
+        self._find_payload()
+        self.pos += 1
+        while True:
+            c = self._skip(self._separator)
+            if c == '}':
+                return
+            key = self._read_value()
+            if self._skip() != ':':
+                raise ValueError("Missing ':' after key %s" % key)
+            self.pos += 1
+            if self._skip() != '[':
+                self._read_value()
+                logger.debug("Skipping non-list element in Doit data: %s", key)
+                continue
+            self.pos += 1
+            while self._skip(self._separator) != ']':
+                yield key, self._read_value()
+            self.pos += 1
+
+def load_doit_file(filename):
+    """Read the Doit data from a file.
+
+    The file is memory mapped, or streamed if it can't be mapped, and read
+    record by record. If that fails, e.g. for broken HTML, the whole file is
+    read and parsed in one go.
+
+    :rtype: Doit
+
+    """
+    with metrics.span('parse', bytes=os.path.getsize(filename)):
+        try:
+            try:
+                return Doit.from_records(iter_mapped_file(filename))
+            except (EnvironmentError, mmap.error), e:
+                logger.debug("Could not memory map %s, streaming it: %s",
+                             filename, e)
+                return Doit.from_records(iter_json_file(filename))
+        except ValueError, e:
+            logger.warn("Failed reading %s record by record, retrying all at "
+                        "once: %s", filename, e)
+            return Doit(parse_json_file(filename))
+
+# Formatted timestamps, by the minute and format. Many tasks share dates. It's
+# cleared when full, as a watching process could see any number of dates.
+_formatted_dates = {}
+_formatted_dates_max = 10000
+
+
 def timestamp_to_date(timestamp, format='%Y-%m-%dT%H:%M'):
     """Convert a Doit timestamp into a format readable by Todoist.
 
     The time is normally not needed, since Todoist only cares about the dates.
 
     """
-    return time.strftime(format, time.gmtime(timestamp/1000))
+    key = (int(timestamp) // 60000, format)
+    try:
+        return _formatted_dates[key]
+    except KeyError:
+        if len(_formatted_dates) >= _formatted_dates_max:
+            _formatted_dates.clear()
+        ret = _formatted_dates[key] = time.strftime(
+                                    format, time.gmtime(int(timestamp)/1000))
+        return ret
+
+day_ms = 24 * 3600 * 1000
+
+
+def next_occurrences(firsts, repeaters, now):
+    """Move the dates of repeating tasks to their next occurrence.
+
+    All the dates are handled in one go, as milliseconds since epoch in an
+    array, like Doit has them. Daily and weekly repeaters are just arithmetic,
+    while monthly and yearly repeaters need the calendar.
+
+    Dates that are in the future, without a repeater, or where the repeater has
+    ended, are kept as they are. So are dates with repeaters that are not
+    understood.
+
+    Many tasks repeat the same way, so the day that each distinct monthly or
+    yearly repeater hits is only found once per month.
+
+    :param array firsts: The first occurrences, or 0 for no date.
+    :param list repeaters: The Doit repeater for each date, or None.
+    :param float now: The time to find the next occurrences after.
+    :rtype: array
+    :return: The next occurrences.
+
+    """
+    nexts = array('d', firsts)
+    current = time.gmtime(int(now) / 1000)
+    now_month = current.tm_year * 12 + current.tm_mon - 1
+    # The occurrences per month of each distinct monthly or yearly repeater,
+    # by its mode and config
+    occurrences = {}
+    for i, rep in enumerate(repeaters):
+        first = nexts[i]
+        if not rep or not first or first >= now:
+            continue
+        mode = rep.get('mode')
+        try:
+            config = rep[mode]
+            cycle = int(config.get('cycle') or 1)
+            if mode == 'daily':
+                step = cycle * day_ms
+                nxt = first + math.ceil((now - first) / step) * step
+            elif mode == 'weekly':
+                nxt = _next_weekly(first, now, cycle, sorted(config['days']))
+            elif mode in ('monthly', 'yearly'):
+                # The repr is enough to tell the configs apart
+                key = (mode, repr(config))
+                nxt = _next_in_calendar(first, now, now_month, cycle, mode,
+                                        config,
+                                        occurrences.setdefault(key, {}))
+            else:
+                continue
+        except (KeyError, IndexError, TypeError, ValueError):
+            continue
+        if nxt is not None and not (rep.get('ends_on') and
+                                    nxt > rep['ends_on']):
+            nexts[i] = nxt
+    return nexts
+
+
+def _next_weekly(first, now, cycle, days):
+    """Return the first of the weekdays at or after now, every cycle weeks."""
+    time_of_day = first % day_ms
+    first_day = int(first // day_ms)
+    min_day = max(first_day,
+                  int(math.ceil((now - time_of_day) / day_ms)))
+    # 1970-01-01 was a Thursday, and Doit counts from Sunday
+    week = first_day - (first_day + 4) % 7
+    period = 7 * cycle
+    week += (min_day - week) // period * period
+    for start in (week, week + period):
+        for d in days:
+            if start + d >= min_day:
+                return (start + d) * day_ms + time_of_day
+    return None
+
+
+def _next_in_calendar(first, now, now_month, cycle, mode, config,
+                      occurrences):
+    """Return the next monthly or yearly occurrence at or after now.
+
+    :param int now_month: The month of now, counted from year 0.
+    :param dict occurrences: The occurrences already found for the repeater,
+        by month, see `_occurrence_in_month`. New ones are added.
+
+    """
+    time_of_day = first % day_ms
+    start = time.gmtime(int(first) / 1000)
+    month = start.tm_year * 12 + start.tm_mon - 1
+    step = cycle
+    if mode == 'yearly':
+        month = start.tm_year * 12 + config['month']
+        step = 12 * cycle
+    month += max(0, (now_month - month) // step * step)
+    for m in (month, month + step, month + 2 * step):
+        try:
+            day = occurrences[m]
+        except KeyError:
+            day = occurrences[m] = _occurrence_in_month(m, config)
+        nxt = day + time_of_day
+        if nxt >= now and nxt >= first:
+            return nxt
+    return None
+
+
+def _occurrence_in_month(month, config):
+    """Return the day in the month that a monthly or yearly repeater hits.
+
+    :param int month: The month, counted from year 0.
+    :rtype: int
+    :return: Milliseconds since epoch, at midnight.
+
+    """
+    year, mon = divmod(month, 12)
+    mon += 1
+    last = calendar.monthrange(year, mon)[1]
+    if 'week' in config:
+        week = config['week']
+        # calendar counts from Monday, Doit from Sunday
+        first_wday = (calendar.weekday(year, mon, 1) + 1) % 7
+        nth = week['week_of_month']
+        day = 1 + (week['day_of_week'] - first_wday) % 7
+        if 1 <= nth <= 4:
+            day += 7 * (nth - 1)
+        else:
+            day += (last - day) // 7 * 7
+    else:
+        day = min(config['day_of_month'], last)
+    return calendar.timegm((year, mon, day, 0, 0, 0)) * 1000
 
 class NotFoundException(Exception):
     """If 'something' was not found."""
@@ -73,47 +500,355 @@ class NotFoundException(Exception):
 
 class CommitException(Exception):
     """If a commit to Todoist failed."""
-    def __init__(self, msg, errors):
+    def __init__(self, msg, errors, commands=()):
         super(CommitException, self).__init__(msg)
         # TODO: Parse and make it easier to e.g. print out the errors?
         self.errors = errors
+        # The commands that Todoist didn't apply
+        self.commands = list(commands)
 
     def __str__(self):
-        print "%s (%s)" % (self.args[0], 
-                           ', '.join(map(str, self.errors.itervalues())))
+        return "%s (%s)" % (self.args[0],
+                            ', '.join(map(str, self.errors.itervalues())))
 
 class UnhandledRepeaterError(Exception):
     """For when the repeat mode hasn't been translated."""
     pass
 
+# Ordinal numbers, for the cycles and days of Doit's repeaters
+ordinals = tuple('%d%s' % (n, 'th' if 10 <= n % 100 <= 20 else
+                           {1: 'st', 2: 'nd', 3: 'rd'}.get(n % 10, 'th'))
+                 for n in range(32))
+
+# Doit counts like javascript, from Sunday and January as 0
+weekday_names = ('sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat')
+month_names = ('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep',
+               'oct', 'nov', 'dec')
+
+# Translated repeaters, by their mode and config. None if not translatable.
+_repeating_strings = {}
+
+
+def translate_repeater(mode, config):
+    """Translate the config of a Doit repeater into a Todoist date string.
+
+    Examples, with a cycle of 1, 2 and 3:
+
+    - daily: "every day", "every other day", "every 3 days"
+    - weekly: "every mon, thu", "every other mon, thu", "every 3 weeks starting
+      mon". Several days can't be combined with a cycle above 2.
+    - monthly: "every 15th" or "every 3rd fri", "every other month starting
+      15th", "every 3 months starting 3rd fri"
+    - yearly: "every dec 21st", "every other year starting dec 21st", and so on
+
+    :raise UnhandledRepeaterError: If Todoist has no way of saying it.
+
+    """
+    try:
+        cycle = int(config.get('cycle') or 1)
+        if mode == 'daily':
+            unit, anchor = 'day', None
+        elif mode == 'weekly':
+            unit = 'week'
+            days = sorted(set(config['days']))
+            if not days:
+                raise UnhandledRepeaterError("Weekly repetition without days")
+            if len(days) > 1 and cycle > 2:
+                raise UnhandledRepeaterError("Several days every %d weeks" %
+                                             cycle)
+            anchor = ', '.join(weekday_names[d] for d in days)
+        elif mode == 'monthly':
+            unit = 'month'
+            if 'week' in config:
+                week = config['week']
+                nth = week['week_of_month']
+                anchor = '%s %s' % ('last' if nth < 1 or nth > 4
+                                    else ordinals[nth],
+                                    weekday_names[week['day_of_week']])
+            else:
+                anchor = ordinals[config['day_of_month']]
+        elif mode == 'yearly':
+            unit = 'year'
+            anchor = '%s %s' % (month_names[config['month']],
+                                ordinals[config['day_of_month']])
+        else:
+            raise UnhandledRepeaterError("Unknown repeat mode: %s" % mode)
+    except (KeyError, IndexError, TypeError, ValueError), e:
+        raise UnhandledRepeaterError("Malformed %s repetition: %s" % (mode, e))
+
+    if cycle == 1:
+        return 'every %s' % (anchor or unit)
+    if cycle == 2 and (mode == 'weekly' or anchor is None):
+        return 'every other %s' % (anchor or unit)
+    every = 'every other %s' % unit if cycle == 2 else 'every %d %ss' % (cycle,
+                                                                         unit)
+    if anchor is None:
+        return every
+    return '%s starting %s' % (every, anchor)
+
+class DoitRecord(object):
+
+    """A compact record from the Doit data.
+
+    Only the fields that the export uses are kept as attributes, in
+    `__slots__`. The rest of the fields are stored as compact JSON, and are
+    first decoded if they are asked for. Fields that were missing in Doit are
+    not set, so that `'project' in task` works as for a dict.
+
+    The records could be read like dicts, e.g. `task['title']`.
+
+    """
+
+    __slots__ = ('_extra',)
+
+    # The fields to keep as attributes
+    _fields = ()
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create a record from Doit's data for it.
+
+        The data is cleaned up, as some elements are a bit messy. For instance
+        could names and titles have newlines in them, probably due to the
+        conversion through JSON.
+
+        """
+        rec = cls()
+        extra = {}
+        for key, value in data.iteritems():
+            if key in cls._fields:
+                if key in ('name', 'title'):
+                    value = value.replace('\n', '')
+                setattr(rec, key, value)
+            else:
+                extra[key] = value
+        rec._extra = json.dumps(extra, separators=(',', ':')) if extra else ''
+        return rec
+
+    def _get_extra(self):
+        """Decode the fields that are not kept as attributes."""
+        if not self._extra:
+            return {}
+        return json.loads(self._extra)
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        return self._get_extra()[key]
+
+    def __contains__(self, key):
+        if key in self._fields:
+            return hasattr(self, key)
+        return key in self._get_extra()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self):
+        """Return all the fields as a dict."""
+        ret = self._get_extra()
+        for key in self._fields:
+            if hasattr(self, key):
+                ret[key] = getattr(self, key)
+        return ret
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.to_dict())
+
+class DoitTask(DoitRecord):
+    """A task from Doit. See `Doit.list_active_tasks` for its fields."""
+    _fields = ('id', 'uuid', 'title', 'notes', 'project', 'tags', 'context',
+               'attribute', 'pos', 'priority', 'repeater', 'start_at', 'end_at',
+               'completed', 'archived', 'deleted', 'trashed', 'usn', 'updated')
+    __slots__ = _fields
+
+class DoitProject(DoitRecord):
+    """A project from Doit. See `Doit.list_active_projects` for its fields."""
+    _fields = ('uuid', 'name', 'notes', 'status', 'pos', 'start_at', 'end_at',
+               'completed', 'archived', 'deleted', 'trashed', 'usn', 'updated')
+    __slots__ = _fields
+
+class DoitLabel(DoitRecord):
+    """A tag or context from Doit."""
+    _fields = ('uuid', 'name')
+    __slots__ = _fields
+
 class Doit:
 
-    """ A representation of the data from Doit.im. """
+    """ A representation of the data from Doit.im.
 
-    def __init__(self, doit_data):
-        self._doit_data = doit_data
+    The tasks, projects, tags and contexts are kept as compact `DoitRecord`s,
+    and the data they are created from is not kept.
 
-        cl = self._cleanup
-        self.tasks = dict((t['id'], cl(t)) for t in doit_data['tasks'])
-        self.tags = dict((t['uuid'], cl(t)) for t in doit_data['tags'])
-        self.contexts = dict((t['uuid'], cl(t)) for t in doit_data['contexts'])
-        self.projects = dict((t['uuid'], cl(t)) for t in doit_data['projects'])
+    When all the records are added, indexes are built for listing and querying
+    the data without going through all of it, see `query`.
+
+    """
+
+    # The lists of records that are used, the key that identifies them and
+    # their record class
+    _record_keys = {'tasks': 'id', 'tags': 'uuid', 'contexts': 'uuid',
+                    'projects': 'uuid'}
+    _record_types = {'tasks': DoitTask, 'tags': DoitLabel,
+                     'contexts': DoitLabel, 'projects': DoitProject}
+
+    def __init__(self, doit_data=None):
+        self.tasks = {}
+        self.tags = {}
+        self.contexts = {}
+        self.projects = {}
         # self.contacts not tested yet
+        self._indexes = None
+        if doit_data:
+            for name in self._record_keys:
+                for record in doit_data[name]:
+                    self.add_record(name, record)
 
-    def _cleanup(self, item):
-        """Do clean up on a given item and return it prettified.
+    @classmethod
+    def from_records(cls, records):
+        """Create the Doit data from an iterator of records.
 
-        Some elements in the various items are a bit messy. For instance could
-        names and titles have newlines in them, probably due to the conversion
-        through JSON.
+        :param records:
+            Tuples with the name of the list and a record, as given by
+            `iter_json_file`. Records in other lists than the used ones are
+            dropped.
 
         """
-        ret = item.copy()
-        # Remove newlines
-        for k in ('name', 'title'):
-            if k in ret:
-                ret[k] = ret[k].replace('\n', '')
-        return ret
+        doit = cls()
+        # The time spent on building the model, apart from the parsing
+        building = 0.0
+        added = 0
+        for name, record in records:
+            if name in cls._record_keys:
+                start = time.time()
+                doit.add_record(name, record)
+                building += time.time() - start
+                added += 1
+        metrics.record('build', building, records=added)
+        return doit
+
+    def add_record(self, name, record):
+        """Add a record to the given list, e.g. a task to 'tasks'."""
+        getattr(self, name)[record[self._record_keys[name]]] = \
+                self._record_types[name].from_dict(record)
+        self._indexes = None
+
+    @staticmethod
+    def is_active(element):
+        """Return True if a task or project is not done or thrown away."""
+        return not (element['trashed'] or element['deleted'] or
+                    element['completed'] or element['archived'])
+
+    def _get_indexes(self):
+        """Return the indexes, and build them if records have been added.
+
+        All the lists of tasks in the indexes are sorted by position.
+
+        """
+        if self._indexes is not None:
+            return self._indexes
+        idx = {'project': {}, 'attribute': {}, 'tag': {}, 'context': {}}
+        tasks = self.sort_by_pos(self.tasks.itervalues())
+        for t in tasks:
+            idx['project'].setdefault(t.get('project'), []).append(t)
+            idx['attribute'].setdefault(t['attribute'], []).append(t)
+            idx['context'].setdefault(t.get('context'), []).append(t)
+            for tag in t.get('tags') or ():
+                idx['tag'].setdefault(tag, []).append(t)
+        idx['all'] = tasks
+        idx['active'] = [t for t in tasks if self.is_active(t)]
+        idx['active_ids'] = set(t['id'] for t in idx['active'])
+        # For finding what's changed since an earlier export
+        idx['by_usn'] = sorted(idx['active'], key=lambda t: t.get('usn') or 0)
+        idx['usns'] = array('d', (t.get('usn') or 0 for t in idx['by_usn']))
+        idx['max_usn'] = max([t.get('usn') or 0 for t in tasks] +
+                             [p.get('usn') or 0 for p in
+                              self.projects.itervalues()] + [0])
+
+        projects = self.sort_by_pos(p for p in self.projects.itervalues()
+                                    if self.is_active(p))
+        idx['active_projects'] = (
+                [p for p in projects if p['status'] == 'active'] +
+                [p for p in projects if p['status'] != 'active'])
+
+        idx['project_names'] = dict((p['name'], p) for p in
+                                    self.projects.itervalues())
+        idx['context_names'] = dict((c['name'], c) for c in
+                                    self.contexts.itervalues())
+        idx['tag_names'] = dict((t['name'], t) for t in self.tags.itervalues())
+        self._indexes = idx
+        return idx
+
+    def query(self, project=None, attribute=None, tag=None, context=None,
+              active=True):
+        """Return the tasks that match all the given criterias.
+
+        The tasks are found through the indexes, starting with the smallest
+        matching index, so only the tasks in that index are checked.
+
+        :param str project: The uuid of the tasks' project
+        :param str attribute: E.g. 'inbox', 'noplan', 'waiting' or 'next'
+        :param str tag: The name of a tag that the tasks must have
+        :param str context: The uuid of the tasks' context
+        :param bool active: If only active tasks should be returned
+
+        :rtype: list
+        :return: The matching tasks, sorted by position.
+
+        """
+        idx = self._get_indexes()
+        criterias = [(k, v) for k, v in (('project', project),
+                                         ('attribute', attribute),
+                                         ('tag', tag), ('context', context))
+                     if v is not None]
+        candidates = [(len(idx[k].get(v, ())), k, v) for k, v in criterias]
+        if candidates:
+            _, key, value = min(candidates)
+            tasks = idx[key].get(value, [])
+        elif active:
+            return list(idx['active'])
+        else:
+            return list(idx['all'])
+
+        def match(t):
+            if active and t['id'] not in idx['active_ids']:
+                return False
+            for k, v in criterias:
+                if k == 'tag':
+                    if v not in (t.get('tags') or ()):
+                        return False
+                elif t.get(k) != v:
+                    return False
+            return True
+        return [t for t in tasks if match(t)]
+
+    def changed_since(self, usn):
+        """Return the active tasks that are changed after the given usn.
+
+        Doit gives every change a new `usn`, so this is what's added or
+        changed since an export with that usn.
+
+        :rtype: list
+        :return: The tasks, sorted by position.
+
+        """
+        idx = self._get_indexes()
+        start = bisect.bisect_right(idx['usns'], usn)
+        return self.sort_by_pos(idx['by_usn'][start:])
+
+    def is_active_task(self, task_id):
+        """Return True if the task is in the data and active."""
+        return task_id in self._get_indexes()['active_ids']
+
+    def max_usn(self):
+        """Return the highest `usn` of the tasks and projects."""
+        return self._get_indexes()['max_usn']
 
     def print_status(self):
         """Print status on the Doit content."""
@@ -137,14 +872,11 @@ class Doit:
 
     def get_project_by_name(self, name):
         """Find a project by its name/title."""
-        if not hasattr(self, '_project_names'):
-            self._project_names = dict((p['name'], p) for p in
-                                       self.projects.itervalues())
-        return self._project_names[name]
+        return self._get_indexes()['project_names'][name]
 
     def list_context_names(self):
         """Return a list of all the contexts, by its names."""
-        return dict((c['name'], c) for c in self.contexts.itervalues())
+        return self._get_indexes()['context_names']
 
     def get_context_name(self, ctx_id):
         """Get the name of a given context."""
@@ -152,11 +884,11 @@ class Doit:
 
     def list_tag_names(self):
         """Return a list of all the tags, by its names."""
-        return dict((t['name'], t) for t in self.tags.itervalues())
+        return self._get_indexes()['tag_names']
 
     def list_project_names(self):
         """Return a list of all the projects, by its names."""
-        return dict((t['name'], t) for t in self.projects.itervalues())
+        return self._get_indexes()['project_names']
 
     def list_active_projects(self):
         """Get all active projects.
@@ -193,19 +925,10 @@ class Doit:
         - end_at: The end date for the project
 
         """
-        active = []
-        inactive = []
-        for k, pr in self.projects.iteritems():
-            if (pr['deleted'] or pr['completed'] or pr['archived'] or
-                    pr['trashed']):
-                continue
-            if pr['status'] == 'active':
-                active.append(pr)
-            else:
-                inactive.append(pr)
-        logger.debug("From Doit, listing %d active and %d inactive projects",
-                     len(active), len(inactive))
-        return self.sort_by_pos(active) + self.sort_by_pos(inactive)
+        ret = self._get_indexes()['active_projects']
+        logger.debug("From Doit, listing %d active or inactive projects",
+                     len(ret))
+        return list(ret)
 
     def list_active_tasks(self):
         """Get all active tasks from Doit data.
@@ -296,15 +1019,9 @@ class Doit:
         - created: When the task was created
 
         """
-        ret = []
-        for k, t in self.tasks.iteritems():
-            if t['trashed'] or t['deleted']:
-                continue
-            if t['completed'] or t['archived']:
-                continue
-            ret.append(t)
+        ret = self.query()
         logger.debug("From Doit, listing %d active tasks", len(ret))
-        return self.sort_by_pos(ret)
+        return ret
 
     @staticmethod
     def sort_by_pos(elements):
@@ -316,220 +1033,1588 @@ class Doit:
         """
         return sorted(elements, key=lambda e: e['pos'])
 
-class TodoistHelperAPI(todoist.TodoistAPI):
-    """Subclassing TodoistAPI for easier code."""
+class IdentityMap:
 
-    def get_label_id_by_name(self, name):
-        """Get the id of a label by searching by its name"""
-        r = self.labels.all(lambda x: x['name'] == name)
-        if len(r) == 1:
-            return r[0]['id']
-        raise NotFoundException('Not found label named: %s' % name)
+    """A persistent mapping from Doit objects to the Todoist objects.
 
-    def get_project_by_name(self, name):
-        """Find the project by the name of the project."""
-        r = self.projects.all(lambda x: x['name'] == name)
-        if len(r) == 1:
-            return r[0]
-        raise NotFoundException('Not found project named: %s' % name)
+    The map is stored in an SQLite database, so that later runs could find
+    what's already exported without searching through the Todoist account. Each
+    Doit object is stored by its kind ('task' or 'project') and id, together
+    with the Todoist id and a fingerprint of the Doit object from when it was
+    exported. If the fingerprint has changed, the Doit object has been modified
+    since then.
 
-    def get_project_id_by_name(self, name):
-        """Find the project id by the name of the project."""
-        return self.get_project_by_name(name)['id']
+    The mappings are first stored when the commands that created or updated the
+    Todoist objects are committed, and removed when the commands that completed
+    or archived them are, see `committed`.
 
-    def get_projectname(self, project_id):
-        """Return the project's name."""
-        return self.projects.get_by_id(project_id)['name']
+    The database also has a journal of the commands sent to Todoist. Every
+    batch is written to the journal before it is sent, see `queued`, and marked
+    as acknowledged in the same transaction as its mappings are stored. If an
+    export gets interrupted, the commands that were never acknowledged could be
+    sent again, see `unacked`. The journal is cleared when an export is done.
 
-    def assert_and_get_project(self, prname):
-        """Shortcut for getting a project, and creating it if doesn't exist."""
-        try:
-            return self.get_project_by_name(prname)
-        except NotFoundException:
-            logger.info('Creating (empty) project: %s', prname)
-            print("Creating project: %s" % prname)
-            r = self.projects.add(prname)
-            self.commit()
-        return self.get_project_by_name(prname)
+    The ledger keeps the uuids of all commands that Todoist has acknowledged,
+    and the ids of what they created, across runs. It is used by
+    `TodoistHelperAPI` to never send the same command twice.
 
-    _max_len_request_uri = 4000
+    """
 
-    def add_note(self, note, item_id=None, project_id=None):
-        """Add a note to Todoist, if it's not already there.
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.execute('CREATE TABLE IF NOT EXISTS mapping ('
+                        'kind TEXT NOT NULL, '
+                        'doit_id TEXT NOT NULL, '
+                        'todoist_id TEXT NOT NULL, '
+                        'fingerprint TEXT, '
+                        'PRIMARY KEY (kind, doit_id))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS journal ('
+                        'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                        'uuid TEXT NOT NULL UNIQUE, '
+                        'command TEXT NOT NULL, '
+                        'kind TEXT, '
+                        'doit_id TEXT, '
+                        'fingerprint TEXT, '
+                        'acked INTEGER NOT NULL DEFAULT 0)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS journal_temp_ids ('
+                        'temp_id TEXT PRIMARY KEY, '
+                        'todoist_id TEXT NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS ledger ('
+                        'uuid TEXT PRIMARY KEY, '
+                        'todoist_id TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS high_water ('
+                        'name TEXT PRIMARY KEY, '
+                        'usn INTEGER NOT NULL)')
+        self.db.commit()
+        self._ledger = dict(self.db.execute('SELECT uuid, todoist_id '
+                                            'FROM ledger'))
+        self._map = dict(((kind, doit_id), (todoist_id, fp)) for
+                         kind, doit_id, todoist_id, fp in
+                         self.db.execute('SELECT kind, doit_id, todoist_id, '
+                                         'fingerprint FROM mapping'))
+        # The number of mapped Doit objects, by kind
+        self._kind_counts = {}
+        for kind, _ in self._map:
+            self._kind_counts[kind] = self._kind_counts.get(kind, 0) + 1
+        # Mappings waiting for their commands to be committed, by Todoist id
+        # or temp_id
+        self._pending = {}
+        # Mappings to remove when their commands are committed, by command uuid
+        self._removals = {}
 
-        If a note with the same content exists for the same item or project, it
-        will not be created once more.
+    @staticmethod
+    def fingerprint(doit_obj):
+        """Return a fingerprint that changes when the Doit object is edited."""
+        return '%s:%s' % (doit_obj.get('usn'), doit_obj.get('updated'))
+
+    def get(self, kind, doit_id):
+        """Return the Todoist id and fingerprint of a Doit object.
 
-        Takes care of long notes by splitting them up.
+        :rtype: tuple
+        :return: The Todoist id and the fingerprint, or None if the Doit object
+            hasn't been exported.
 
         """
-        assert item_id or project_id, "Missing item or project id"
-        note = note.strip()
+        ret = self._map.get((kind, doit_id))
+        if ret is None:
+            return None
+        todoist_id, fp = ret
+        # SQLite gives back text, while Todoist's ids are integers
+        if todoist_id.isdigit():
+            todoist_id = int(todoist_id)
+        return todoist_id, fp
+
+    def has_kind(self, kind):
+        """Return True if any Doit object of the given kind is mapped."""
+        return self._kind_counts.get(kind, 0) > 0
+
+    def doit_ids(self, kind):
+        """Return the ids of the mapped Doit objects of the given kind."""
+        return [doit_id for k, doit_id in self._map if k == kind]
+
+    def forget(self, kind, doit_id, commit=True):
+        """Remove the mapping of a Doit object, right away."""
+        if self._map.pop((kind, doit_id), None) is not None:
+            self._kind_counts[kind] -= 1
+        self.db.execute('DELETE FROM mapping WHERE kind = ? AND doit_id = ?',
+                        (kind, doit_id))
+        if commit:
+            self.db.commit()
+
+    def remove(self, kind, doit_id, uuid):
+        """Remove the mapping of a Doit object, when it gets committed.
+
+        E.g. when it's completed or archived. Until Todoist has acknowledged
+        the command, the Doit object is still mapped, so that an export that
+        fails could be run again.
+
+        :param uuid: The uuid of the command that removes the Todoist object.
 
-        if item_id:
-            logger.info("Add note for item_id=%s: '%s...' (%d chars)", item_id,
-                        note[:200].replace('\n', ''), len(note))
-        else:
-            logger.info("Add project note for project_id=%s: '%s...' "
-                        "(%d chars)", project_id, note[:200].replace('\n', ''),
-                        len(note))
-        def match(n):
-            if item_id and n['item_id'] != item_id:
-                return False
-            if project_id and n['project_id'] != project_id:
-                return False
-            return n['content'] == note
+        """
+        self._removals[uuid] = (kind, doit_id)
 
-        existing = self.notes.all(filt=match)
-        if existing:
-            logger.debug("Note already created, skipping")
-            return existing[0]
-
-        if len(note) > self._max_len_request_uri:
-            logger.debug("Note too long (%d chars), splitting", len(note))
-            logger.debug("...for now, only cutting out the first part")
-            # TODO: Split!
-            # For now, I'm only cutting out the first part...
-            return self.notes.add(item_id=item_id, project_id=project_id,
-                                  content=note[:self._max_len_request_uri])
-        else:
-            return self.notes.add(item_id=item_id, content=note,
-                                  project_id=project_id)
+    def high_water_usn(self):
+        """Return the highest Doit `usn` that has been exported, if any."""
+        row = self.db.execute('SELECT usn FROM high_water WHERE name = ?',
+                              ('doit',)).fetchone()
+        return row[0] if row else None
 
-    def assert_project(self, name, **kwargs):
-        """Assert that a given project exists and is updated.
+    def set_high_water_usn(self, usn):
+        """Store the highest Doit `usn` of a finished export."""
+        self.db.execute('INSERT OR REPLACE INTO high_water (name, usn) '
+                        'VALUES (?, ?)', ('doit', usn))
+        self.db.commit()
 
-        Makes sure that the given details are correct. Uses the *name* of the
-        project as identificator in Todoist.
+    def add(self, kind, doit_id, todoist_id, fingerprint):
+        """Map a Doit object to a Todoist object, when it gets committed.
 
-        :rtype: bool
-        :return: True if the project was created, otherwise False.
+        :param todoist_id:
+            The id of the Todoist object, or its temp_id if it's just queued.
 
         """
-        created = False
-        try:
-            project = self.get_project_by_name(name)
-        except NotFoundException:
-            project = self.add_project(name, **kwargs)
-            created = True
-        else:
-            needs_update = False
-            print kwargs
-            for key, val in kwargs.iteritems():
-                if key == 'notes':
-                    # notes are special
-                    continue
-                if project.data.get(key) != val:
-                    needs_update = True
-            if needs_update:
-                logger.info('Updating project "%s" with: %s', name, kwargs)
-                project.update(**kwargs)
-            else:
-                logger.debug("No need to update project: %s", name)
-        if kwargs.get('notes'):
-            # TODO: Check if note is already added to the project
-            self.add_note(kwargs['notes'], project_id=project['id'])
-            try:
-                self.commit()
-            except CommitException, e:
-                logger.warn("Failed adding project note to %s: %s", name, e)
-                print "Failed adding project note to %s" % name
-        self.commit()
-        return created
+        self._pending[todoist_id] = (kind, doit_id, fingerprint)
+
+    def set(self, kind, doit_id, todoist_id, fingerprint, commit=True):
+        """Map a Doit object to an existing Todoist object, right away."""
+        todoist_id = unicode(todoist_id)
+        if (kind, doit_id) not in self._map:
+            self._kind_counts[kind] = self._kind_counts.get(kind, 0) + 1
+        self._map[(kind, doit_id)] = (todoist_id, fingerprint)
+        self.db.execute('INSERT OR REPLACE INTO mapping (kind, doit_id, '
+                        'todoist_id, fingerprint) VALUES (?, ?, ?, ?)',
+                        (kind, doit_id, todoist_id, fingerprint))
+        if commit:
+            self.db.commit()
+
+    def flush(self):
+        """Write what was set with commit=False to the database."""
+        self.db.commit()
 
-    def add_project(self, name, **kwargs):
-        """Add a project to Todoist and commit.
+    @staticmethod
+    def command_object_id(cmd):
+        """Return the temp_id or id of the object that a command is for."""
+        return cmd.get('temp_id') or cmd.get('args', {}).get('id')
+
+    def queued(self, commands):
+        """Write a batch of commands to the journal, before they are sent.
+
+        This is added as a send listener to `TodoistHelperAPI`.
 
-        :rtype: todoist.models.Project
-        :return: The created project
-        
         """
-        logger.info("Creating project: '%s', with args: %s", name, kwargs)
-        p = self.projects.add(name, **kwargs)
-        self.commit()
-        return p
+        for cmd in commands:
+            kind, doit_id, fp = self._pending.get(self.command_object_id(cmd),
+                                                  (None, None, None))
+            self.db.execute('INSERT OR REPLACE INTO journal (uuid, command, '
+                            'kind, doit_id, fingerprint) VALUES (?, ?, ?, ?, ?)',
+                            (cmd['uuid'], json.dumps(cmd), kind, doit_id, fp))
+        self.db.commit()
 
-    def add_item(self, content, project_id, **kwargs):
-        """Add an item to Todoist and commit.
+    def committed(self, commands, response):
+        """Store the mappings of the commands that Todoist has accepted.
 
-        The note is added as well.
+        The commands are marked as acknowledged in the journal.
 
-        :param list labels:
-            The list of labels to add to the item. Note that these should be the
-            name of the label and not its ID, as this is translated.
+        This is added as a commit listener to `TodoistHelperAPI`.
 
-        :rtype: todoist.models.Item
-        :return: The created item
-       
         """
-        logger.info("Creating item: '%s', for project %s (%s), with args: %s",
-                content, project_id, self.get_projectname(project_id), kwargs)
-        if kwargs.get('labels'):
-            kwargs['labels'] = [self.get_label_id_by_name(l) for l in
-                                kwargs['labels']]
-        else:
-            kwargs['labels'] = ()
-        notes = kwargs.get('notes')
-        # Add notes separately, after the item has been created
-        if 'notes' in kwargs:
-            del kwargs['notes']
-        it = self.items.add(content=content, project_id=project_id, **kwargs)
-        self.commit()
-        if notes:
-            self.add_note(notes, item_id=it['id'])
-        self.commit()
-        return it
+        mapping = {}
+        if isinstance(response, dict):
+            mapping = response.get('temp_id_mapping') or {}
+        for temp_id, todoist_id in mapping.iteritems():
+            self.db.execute('INSERT OR REPLACE INTO journal_temp_ids (temp_id, '
+                            'todoist_id) VALUES (?, ?)',
+                            (temp_id, unicode(todoist_id)))
+        for cmd in commands:
+            self.db.execute('UPDATE journal SET acked = 1 WHERE uuid = ?',
+                            (cmd['uuid'],))
+            todoist_id = mapping.get(cmd.get('temp_id'))
+            if todoist_id is not None:
+                todoist_id = unicode(todoist_id)
+            self._ledger[cmd['uuid']] = todoist_id
+            self.db.execute('INSERT OR REPLACE INTO ledger (uuid, todoist_id) '
+                            'VALUES (?, ?)', (cmd['uuid'], todoist_id))
+            removal = self._removals.pop(cmd['uuid'], None)
+            if removal is not None:
+                self.forget(*removal, commit=False)
+            obj_id = self.command_object_id(cmd)
+            if obj_id not in self._pending:
+                continue
+            kind, doit_id, fp = self._pending.pop(obj_id)
+            self.set(kind, doit_id, mapping.get(obj_id, obj_id), fp,
+                     commit=False)
+        self.db.commit()
 
-    def add_inbox_item(self, content):
-        """Add an item to Todoist's Inbox.
-        
-        This is a shortcut for a simple task, just adding something to the
-        Inbox. If you want so set some params, please see `add_item`.
-        
-        """
-        if not hasattr(self, '_inbox_id'):
-            self._inbox_id = self.get_project_id_by_name('Inbox')
-        return self.add_item(content=content, project_id = self._inbox_id)
+    def is_acked(self, uuid):
+        """Return True if Todoist has acknowledged the command with the uuid."""
+        return uuid in self._ledger
 
-    def commit(self):
-        """Commit and check feedback and raise Exception.
+    def acked_id(self, uuid):
+        """Return the id of what an acknowledged command created, if any."""
+        todoist_id = self._ledger.get(uuid)
+        if todoist_id is not None and todoist_id.isdigit():
+            return int(todoist_id)
+        return todoist_id
 
-        This is for easier code, rasising errors if something is wrong. It also
-        have simple handling of request limits.
+    def unacked(self):
+        """Return the commands in the journal that were never acknowledged.
 
-        """
-        errors = {}
-        logger.debug("Sending commit message to Todoist")
-        logger.debug("Commit queue: %s", self.queue)
-        ret = super(TodoistHelperAPI, self).commit()
-        logger.debug("Commit response: %s", ret)
-        # Handle limit block exceptions specially, by rerunning it after a few
-        # seconds:
-        if isinstance(ret, dict) and ret.get('error_tag') == 'LIMITS_REACHED':
-            logger.debug("Todoist's request limit reached, pause and rerun")
-            time.sleep(10)
-            return self.commit()
+        :rtype: list
+        :return: Tuples with the command, in the order they were sent, and the
+            kind, id and fingerprint of the Doit object it is for, if any.
 
-        if isinstance(ret, dict):
-            if 'error' in ret:
-                logger.error("Error from Todoist: %s", ret)
-                raise CommitException('Commit to Todoist failed', ret)
-            for key, row in ret.iteritems():
-                if isinstance(row, dict) and 'error' in row:
-                    logger.error("Errors from Todoist: %s: %s", key, row)
-                    errors[key] = row
-        if errors:
-            raise CommitException('Commit to Todoist failed, %d errors' %
-                                  len(errors), errors)
+        """
+        return [(json.loads(cmd), kind, doit_id, fp) for
+                cmd, kind, doit_id, fp in
+                self.db.execute('SELECT command, kind, doit_id, fingerprint '
+                                'FROM journal WHERE acked = 0 ORDER BY seq')]
+
+    def journal_temp_ids(self):
+        """Return the temp_id mappings that Todoist has given in the journal."""
+        ret = {}
+        for temp_id, todoist_id in self.db.execute('SELECT temp_id, todoist_id '
+                                                   'FROM journal_temp_ids'):
+            ret[temp_id] = int(todoist_id) if todoist_id.isdigit() else \
+                    todoist_id
         return ret
 
-    def get_max_project_position(self):
-        """Get the max `item_order` set in Todoist for projects."""
-        return max(p['item_order'] for p in self.projects.all())
+    def clear_journal(self):
+        """Remove the acknowledged commands from the journal.
 
-class Todoist_exporter:
+        Commands that were never acknowledged are kept, so that they could still
+        be sent again, see `unacked`. So are the temp_ids, while there are any.
 
-    """ Class that handles the export to Todoist. """
+        """
+        self.db.execute('DELETE FROM journal WHERE acked = 1')
+        if self.db.execute('SELECT 1 FROM journal LIMIT 1').fetchone() is None:
+            self.db.execute('DELETE FROM journal_temp_ids')
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+class Metrics(object):
+    """Timing spans for the phases of a run, to see where the time goes.
+
+    Every span has a name, e.g. "parse" or "commit", a duration and counters,
+    e.g. the number of commands. The spans are summarized per name, with a
+    histogram of the durations, and saved as JSON by `save`.
+
+    Spans could be recorded from several threads.
+
+    """
+
+    # The upper bounds of the histogram buckets, in seconds
+    buckets = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5,
+               10, 30, 60, 300)
+
+    def __init__(self):
+        self.started = time.time()
+        self._phases = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, **counters):
+        """Time the code in the with block.
+
+        The counters could be updated in the block:
+
+            with metrics.span('commit', commands=10) as span:
+                span['retries'] = 1
+
+        """
+        start = time.time()
+        try:
+            yield counters
+        finally:
+            self.record(name, time.time() - start, **counters)
+
+    def record(self, name, seconds, **counters):
+        """Add a span that is timed elsewhere."""
+        with self._lock:
+            phase = self._phases.get(name)
+            if phase is None:
+                phase = self._phases[name] = {
+                    'count': 0, 'seconds': 0.0, 'durations': [],
+                    'histogram': [0] * (len(self.buckets) + 1),
+                    'counters': {}}
+            phase['count'] += 1
+            phase['seconds'] += seconds
+            phase['durations'].append(seconds)
+            i = 0
+            while i < len(self.buckets) and seconds > self.buckets[i]:
+                i += 1
+            phase['histogram'][i] += 1
+            for key, value in counters.iteritems():
+                phase['counters'][key] = phase['counters'].get(key, 0) + value
+
+    def summary(self):
+        """Return the spans summarized per name.
+
+        Spans that count bytes, like "sync" and "batch", also get the bytes per
+        second.
+
+        :rtype: dict
+
+        """
+        ret = {}
+        with self._lock:
+            for name, phase in self._phases.iteritems():
+                durations = sorted(phase['durations'])
+
+                def percentile(p):
+                    return durations[min(len(durations) - 1,
+                                         int(p * len(durations)))]
+                histogram = [['<=%g' % b, n] for b, n in
+                             zip(self.buckets, phase['histogram'])]
+                histogram.append(['>%g' % self.buckets[-1],
+                                  phase['histogram'][-1]])
+                ret[name] = {'count': phase['count'],
+                             'seconds': phase['seconds'],
+                             'mean': phase['seconds'] / phase['count'],
+                             'min': durations[0], 'max': durations[-1],
+                             'p50': percentile(0.5), 'p90': percentile(0.9),
+                             'p99': percentile(0.99),
+                             'histogram': [h for h in histogram if h[1]],
+                             'counters': dict(phase['counters'])}
+                sent = phase['counters'].get('bytes')
+                if sent is not None and phase['seconds']:
+                    ret[name]['bytes_per_second'] = sent / phase['seconds']
+        return ret
+
+    def save(self, filename):
+        """Write the summary of the run as JSON."""
+        data = {'started': self.started,
+                'seconds': time.time() - self.started,
+                'phases': self.summary()}
+        with open(filename, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+
+    def print_status(self):
+        """Print how much time each phase took."""
+        for name, phase in sorted(self.summary().iteritems(),
+                                  key=lambda x: -x[1]['seconds']):
+            line = "%10.2fs %6d x %s" % (phase['seconds'], phase['count'],
+                                         name)
+            if 'bytes' in phase['counters']:
+                line += ", %d bytes" % phase['counters']['bytes']
+            print line
+
+# The metrics for this run
+metrics = Metrics()
+
+class RateLimiter:
+
+    """Pace the requests to Todoist, to stay within its request limits.
+
+    This is a token bucket. Each request takes a token, and the tokens are
+    refilled at the rate of `per_minute` requests per minute, up to `burst`
+    tokens. When the bucket is empty, `acquire` sleeps until the next token is
+    available.
+
+    If Todoist still says that the limit is reached, `backoff` sleeps for what
+    Todoist asks for, or else for an exponentially growing, random time.
+
+    The limiter could be shared by several threads.
+
+    """
+
+    def __init__(self, per_minute=50, burst=None, base_delay=1.0,
+                 max_delay=120.0):
+        self.rate = per_minute / 60.0
+        self.burst = burst or max(1, per_minute / 10)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.tokens = float(self.burst)
+        self.updated = time.time()
+        # Total number of seconds spent waiting, for statistics
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def _sleep(self, seconds):
+        self.waited += seconds
+        time.sleep(seconds)
+
+    def acquire(self):
+        """Take a token, and wait for it if there are none left.
+
+        Threads waiting for tokens get them one at a time.
+
+        """
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                wait = (1 - self.tokens) / self.rate
+                logger.debug("Pacing requests to Todoist, waiting %.2f "
+                             "seconds", wait)
+                self._sleep(wait)
+                self.tokens = 1.0
+                self.updated = time.time()
+            self.tokens -= 1
+
+    def backoff(self, attempt, retry_after=None):
+        """Wait after Todoist has said that the request limit is reached.
+
+        :param int attempt: The number of the retry, starting at 0.
+        :param retry_after: Seconds to wait, if told by Todoist.
+
+        """
+        if retry_after:
+            delay = float(retry_after) + random.uniform(0, self.base_delay)
+        else:
+            delay = random.uniform(0, min(self.max_delay,
+                                          self.base_delay * 2 ** attempt))
+        with self._lock:
+            # The bucket is obviously empty
+            self.tokens = 0.0
+            self.updated = time.time() + delay
+            self.waited += delay
+        logger.debug("Todoist's request limit reached, waiting %.2f seconds",
+                     delay)
+        time.sleep(delay)
+
+def summarize_commands(commands):
+    """Return a short description of commands, for logging.
+
+    :rtype: str
+    :return: E.g. "3 commands: item_add=2, note_add=1"
+
+    """
+    types = {}
+    for cmd in commands:
+        types[cmd.get('type')] = types.get(cmd.get('type'), 0) + 1
+    return '%d commands: %s' % (len(commands), ', '.join(
+                        '%s=%d' % t for t in sorted(types.iteritems())))
+
+def summarize_response(response):
+    """Return a short description of a response from Todoist, for logging.
+
+    :rtype: str
+    :return: E.g. "sync_status=3 (1 failed), items=2, temp_id_mapping=3"
+
+    """
+    if not isinstance(response, dict):
+        return '%s response' % type(response).__name__
+    if 'error' in response:
+        return 'error: %s' % response
+    parts = []
+    for key, value in sorted(response.iteritems()):
+        if key == 'sync_status':
+            failed = sum(1 for v in value.itervalues() if v != 'ok')
+            parts.append('sync_status=%d (%d failed)' % (len(value), failed))
+        elif isinstance(value, (list, dict)) and value:
+            parts.append('%s=%d' % (key, len(value)))
+    return ', '.join(parts)
+
+class TodoistHelperAPI(todoist.TodoistAPI):
+    """Subclassing TodoistAPI for easier code.
+
+    Commands are not sent to Todoist one by one. The managers put them in
+    `self.queue` with temp_ids, and the queue is first sent by `commit_if_full`
+    when it has grown to `batch_size` commands, or by `commit`. Later
+    commands could therefore refer to objects that are not created yet, e.g. a
+    note to an item in the same batch. When a batch has been sent, the temp_ids
+    are mapped to the real ids, see `real_id`.
+
+    Projects and labels are indexed by name and id, to avoid scanning the whole
+    local state for every lookup. The indexes are rebuilt at every sync, and
+    kept updated when objects are added and when temp_ids get mapped. Notes are
+    indexed by their item or project and a digest of their content. The library
+    itself scans the local state for every temp_id and every object in a
+    response, which gets slow for big accounts, so it is made to use the id
+    indexes too, see `_find_object` and `_replace_temp_id`.
+
+    Callables in `send_listeners` are called with every batch of commands right
+    before it's sent, and callables in `commit_listeners` are called with the
+    sent commands and the response for every batch that Todoist has accepted.
+
+    All requests go through the `limiter`, see `RateLimiter`.
+
+    Commands queued with a `source`, e.g. the Doit task they are for, get a
+    uuid derived from it instead of a random one. The same command gets the
+    same uuid in every retry and every run, so Todoist ignores it if it was
+    already applied. The `ledger`, if set, tells what uuids Todoist has already
+    acknowledged, so they're not sent at all. See `IdentityMap`.
+
+    With `concurrency` above 1, big commits are sent as several batches at the
+    same time, see `_commit_concurrently`.
+
+    """
+
+    # The namespace for the uuids of commands
+    _uuid_namespace = uuid.uuid5(uuid.NAMESPACE_URL,
+                                 'https://github.com/jokim/doit2todoist')
+
+    # Max number of commands to send to Todoist per request
+    batch_size = 100
+
+    # Max number of retries when Todoist's request limit is reached
+    max_retries = 8
+
+    # Max number of batches to have in flight at the same time
+    concurrency = 1
+
+    # Share of the requests and responses to log in full at debug level. The
+    # rest are only summarized.
+    payload_log_rate = 0.0
+
+    def __init__(self, token, batch_size=None, limiter=None, concurrency=None,
+                 max_request_size=None, **kwargs):
+        # The library's own cache writes the whole state at every sync, which
+        # gets slow, and `load_state` and `save_state` do the same job
+        kwargs.setdefault('cache', None)
+        super(TodoistHelperAPI, self).__init__(token, **kwargs)
+        if batch_size:
+            self.batch_size = batch_size
+        if max_request_size:
+            self.max_request_size = max_request_size
+        if concurrency:
+            self.concurrency = concurrency
+            self._setup_connection_pool()
+        self.limiter = limiter or RateLimiter()
+        self.send_listeners = []
+        self.commit_listeners = []
+        self.ledger = None
+        self._build_indexes()
+
+    # The managers that are indexed by name and id
+    _indexed = ('projects', 'labels')
+
+    def _build_indexes(self):
+        """Rebuild the name and id indexes from the local state."""
+        self._by_name = dict((k, {}) for k in self._indexed)
+        self._by_id = dict((k, {}) for k in self._indexed)
+        self._duplicate_names = dict((k, set()) for k in self._indexed)
+        for kind in self._indexed:
+            for obj in getattr(self, kind).all():
+                self._index(kind, obj)
+        for kind in ('items', 'notes', 'project_notes'):
+            self._by_id[kind] = dict((o['id'], o) for o in
+                                     getattr(self, kind).all())
+        self._notes_by_parent = {}
+        for n in self.notes.all() + self.project_notes.all():
+            self._index_note(n, n['content'].strip(),
+                             item_id=n.data.get('item_id'),
+                             project_id=n.data.get('project_id'))
+
+    @staticmethod
+    def _note_parent(item_id=None, project_id=None):
+        """Return the key for a note's item or project in the note index."""
+        if item_id:
+            return ('item', item_id)
+        return ('project', project_id)
+
+    @staticmethod
+    def _note_digest(content):
+        """Return the digest that notes are indexed by."""
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        return hashlib.md5(content).digest()
+
+    def _index_note(self, note, content, item_id=None, project_id=None):
+        """Add a note to the note index."""
+        kind = 'notes' if item_id else 'project_notes'
+        self._by_id[kind][note['id']] = note
+        parent = self._note_parent(item_id, project_id)
+        notes = self._notes_by_parent.setdefault(parent, {})
+        notes.setdefault(self._note_digest(content), note)
+
+    def _index(self, kind, obj):
+        """Add a project or label to the indexes."""
+        name = obj['name']
+        other = self._by_name[kind].get(name)
+        if other is not None and other is not obj:
+            logger.warn("Several %s in Todoist named: %s", kind, name)
+            self._duplicate_names[kind].add(name)
+        self._by_name[kind][name] = obj
+        self._by_id[kind][obj['id']] = obj
+
+    def _replace_temp_id(self, temp_id, new_id):
+        """Give the object its real id, and move it in the indexes.
+
+        Overrides the library's, which scans all objects.
+
+        """
+        found = False
+        for ids in self._by_id.itervalues():
+            obj = ids.pop(temp_id, None)
+            if obj is not None:
+                obj['id'] = new_id
+                ids[new_id] = obj
+                found = True
+        for kind in ('item', 'project'):
+            notes = self._notes_by_parent.pop((kind, temp_id), None)
+            if notes is not None:
+                self._notes_by_parent[(kind, new_id)] = notes
+        if not found:
+            return super(TodoistHelperAPI, self)._replace_temp_id(temp_id,
+                                                                  new_id)
+        return True
+
+    def _find_object(self, objtype, obj):
+        """Find an object in the local state by the id indexes.
+
+        Overrides the library's, which scans all objects of the type.
+
+        """
+        ids = getattr(self, '_by_id', {}).get(objtype)
+        if ids is None:
+            return super(TodoistHelperAPI, self)._find_object(objtype, obj)
+        return ids.get(obj['id'])
+
+    def _update_state(self, syncdata):
+        """Update the local state, and the indexes if objects came or went."""
+        super(TodoistHelperAPI, self)._update_state(syncdata)
+        if not hasattr(self, '_by_id'):
+            return
+        for kind, ids in self._by_id.iteritems():
+            for obj in syncdata.get(kind, ()):
+                if obj.get('is_deleted') or obj['id'] not in ids:
+                    self._build_indexes()
+                    return
+
+    def _request(self, request):
+        """Do a request to Todoist, paced by the limiter and with retries.
+
+        :param callable request: Does the request and returns the response.
+
+        """
+        with metrics.span('request', retries=0, wait_seconds=0.0) as span:
+            return self._retry(request, span)
+
+    def _retry(self, request, span):
+        waited = self.limiter.waited
+        for attempt in xrange(self.max_retries + 1):
+            span['retries'] = attempt
+            self.limiter.acquire()
+            try:
+                ret = request()
+            except EnvironmentError, e:
+                # The errors from requests are IOErrors
+                if attempt >= self.max_retries:
+                    raise
+                logger.warn("Request to Todoist failed, retrying: %s", e)
+                self.limiter.backoff(attempt)
+                continue
+            if not (isinstance(ret, dict) and
+                    ret.get('error_tag') == 'LIMITS_REACHED'):
+                break
+            if attempt < self.max_retries:
+                extra = ret.get('error_extra') or {}
+                self.limiter.backoff(attempt, extra.get('retry_after'))
+        span['wait_seconds'] = self.limiter.waited - waited
+        return ret
+
+    def sync(self, *args, **kwargs):
+        """Sync with Todoist and update the indexes.
+
+        The request is paced by the rate limiter, and retried if Todoist says
+        that the request limit is reached, or if the request fails. Commands
+        are retried with the same uuids, so Todoist doesn't apply them twice.
+
+        A commit only gives temp_id mappings to update, while a regular sync
+        could change anything, so the indexes are then rebuilt.
+
+        :param int size: The bytes of the commands, if already known, see
+            `command_size`. Only for the metrics.
+
+        """
+        size = kwargs.pop('size', None)
+        commands = kwargs.get('commands') or ()
+        if size is None:
+            size = sum(self.command_size(c) for c in commands)
+        with metrics.span('sync', commands=len(commands), bytes=size):
+            ret = self._request(lambda: super(TodoistHelperAPI,
+                                              self).sync(*args, **kwargs))
+            if not commands:
+                self._build_indexes()
+        return ret
+
+    def _setup_connection_pool(self):
+        """Make the HTTP session keep a connection per concurrent batch."""
+        try:
+            from requests.adapters import HTTPAdapter
+        except ImportError:
+            return
+        if hasattr(self.session, 'mount'):
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=self.concurrency)
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+
+    def _get_by_name(self, kind, name):
+        """Get a uniquely named project or label from the index."""
+        if name in self._duplicate_names[kind]:
+            raise NotFoundException('Several %s named: %s' % (kind, name))
+        try:
+            return self._by_name[kind][name]
+        except KeyError:
+            raise NotFoundException('Not found %s named: %s' % (kind, name))
+
+    def get_label_id_by_name(self, name):
+        """Get the id of a label by searching by its name"""
+        return self._get_by_name('labels', name)['id']
+
+    def get_project_by_name(self, name):
+        """Find the project by the name of the project."""
+        return self._get_by_name('projects', name)
+
+    def has_note(self, note, item_id=None, project_id=None):
+        """Return True if the note is already added to the item or project."""
+        return self._find_note(self.split_note(note.strip()), item_id,
+                               project_id) is not None
+
+    def _find_note(self, parts, item_id=None, project_id=None):
+        """Return the added note with the given parts, see `split_note`.
+
+        Split notes are recognized by their first part.
+
+        """
+        parent = self._note_parent(item_id, project_id)
+        return self._notes_by_parent.get(parent, {}).get(
+                                                self._note_digest(parts[0]))
+
+    def has_label(self, name):
+        """Return True if a label with the given name exists."""
+        return name in self._by_name['labels']
+
+    def get_project_id_by_name(self, name):
+        """Find the project id by the name of the project."""
+        return self.get_project_by_name(name)['id']
+
+    def get_projectname(self, project_id):
+        """Return the project's name."""
+        return self._by_id['projects'][project_id]['name']
+
+    def get_project(self, project_id):
+        """Return a project from the local state, or None if not found."""
+        return self._by_id['projects'].get(project_id)
+
+    def get_item(self, item_id):
+        """Return an item from the local state, or None if not found."""
+        return self._by_id['items'].get(item_id)
+
+    def assert_and_get_project(self, prname):
+        """Shortcut for getting a project, and creating it if doesn't exist."""
+        try:
+            return self.get_project_by_name(prname)
+        except NotFoundException:
+            logger.info('Creating (empty) project: %s', prname)
+            print("Creating project: %s" % prname)
+            return self.add_project(prname)
+
+    # Max number of chars in a note. Longer notes are split in several.
+    _max_len_request_uri = 4000
+
+    # Max number of bytes of commands to send to Todoist per request
+    max_request_size = 512 * 1024
+
+    def stable_uuid(self, name):
+        """Return a uuid that is always the same for the name and account."""
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        return str(uuid.uuid5(self._uuid_namespace,
+                              '%s:%s' % (self._state_owner(), name)))
+
+    def _stamp_commands(self, source, start):
+        """Give the commands queued from `start` uuids derived from source."""
+        if source is None:
+            return
+        for i, cmd in enumerate(self.queue[start:]):
+            cmd['uuid'] = self.stable_uuid('%s:%s:%d' % (source, cmd['type'],
+                                                         i))
+
+    def add_note(self, note, item_id=None, project_id=None, source=None):
+        """Add a note to Todoist, if it's not already there.
+
+        If a note with the same content exists for the same item or project, it
+        will not be created once more.
+
+        Takes care of long notes by splitting them up, see `split_note`. The
+        parts are added as separate notes, in order.
+
+        :rtype: todoist.models.Note
+        :return: The note, or the first part of it.
+
+        """
+        assert item_id or project_id, "Missing item or project id"
+        note = note.strip()
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Add note for %s: '%s...' (%d chars)",
+                         'item_id=%s' % item_id if item_id else
+                         'project_id=%s' % project_id,
+                         note[:200].replace('\n', ''), len(note))
+        parts = self.split_note(note)
+        existing = self._find_note(parts, item_id, project_id)
+        if existing is not None:
+            logger.debug("Note already created, skipping")
+            return existing
+
+        if len(parts) > 1:
+            logger.debug("Note too long (%d chars), split in %d notes",
+                         len(note), len(parts))
+        start = len(self.queue)
+        first = None
+        for part in parts:
+            if item_id:
+                n = self.notes.add(item_id, part)
+            else:
+                n = self.project_notes.add(project_id, part)
+            self._index_note(n, part, item_id=item_id, project_id=project_id)
+            first = first or n
+        self._stamp_commands(source, start)
+        return first
+
+    def split_note(self, note):
+        """Split a note in parts that are short enough for Todoist.
+
+        The note is split at line breaks or whitespace when possible. When
+        split, each part is prefixed with its number, e.g. "(2/3)", so the
+        order is clear in Todoist.
+
+        :rtype: list
+        :return: The parts of the note. A short note is returned as is.
+
+        """
+        if len(note) <= self._max_len_request_uri:
+            return [note]
+        # Room for the "(i/n) " prefix
+        size = self._max_len_request_uri - 20
+        parts = []
+        while len(note) > size:
+            cut = note.rfind('\n', size // 2, size)
+            if cut == -1:
+                cut = note.rfind(' ', size // 2, size)
+            if cut == -1:
+                cut = size
+            parts.append(note[:cut].rstrip())
+            note = note[cut:].lstrip()
+        if note:
+            parts.append(note)
+        return ['(%d/%d) %s' % (i, len(parts), part)
+                for i, part in enumerate(parts, 1)]
+
+    def assert_project(self, name, **kwargs):
+        """Assert that a given project exists and is updated.
+
+        Makes sure that the given details are correct. Uses the *name* of the
+        project as identificator in Todoist.
+
+        :rtype: bool
+        :return: True if the project was created, otherwise False.
+
+        """
+        try:
+            project = self.get_project_by_name(name)
+        except NotFoundException:
+            self.add_project(name, **kwargs)
+            return True
+        else:
+            needs_update = False
+            logger.debug("Asserting project %s: %s", name, kwargs)
+            for key, val in kwargs.iteritems():
+                if key == 'notes':
+                    # notes are special
+                    continue
+                if project.data.get(key) != val:
+                    needs_update = True
+            if needs_update:
+                logger.info('Updating project "%s" with: %s', name, kwargs)
+                project.update(**kwargs)
+            else:
+                logger.debug("No need to update project: %s", name)
+        if kwargs.get('notes'):
+            # TODO: Check if note is already added to the project
+            self.add_note(kwargs['notes'], project_id=project['id'])
+        return False
+
+    def add_project(self, name, source=None, **kwargs):
+        """Queue a project for Todoist.
+
+        :param str source: What the project is created from, for giving the
+            commands stable uuids.
+
+        :rtype: todoist.models.Project
+        :return: The created project, with a temp_id until it's committed
+        
+        """
+        logger.info("Creating project: '%s', with args: %s", name, kwargs)
+        start = len(self.queue)
+        notes = kwargs.pop('notes', None)
+        p = self.projects.add(name, **kwargs)
+        self._index('projects', p)
+        if notes:
+            self.add_note(notes, project_id=p['id'])
+        self._stamp_commands(source, start)
+        return p
+
+    def update_project(self, project, source=None, **kwargs):
+        """Queue an update of a project in Todoist.
+
+        The source is used for stable uuids, as in `add_project`.
+
+        """
+        logger.info('Updating project "%s" with: %s', project['name'], kwargs)
+        start = len(self.queue)
+        project.update(**kwargs)
+        self._stamp_commands(source, start)
+        return project
+
+    def add_label(self, name):
+        """Queue a label for Todoist.
+
+        Labels are identified by their name, so it's used for the uuid.
+
+        :rtype: todoist.models.Label
+        :return: The created label, with a temp_id until it's committed
+
+        """
+        logger.debug("Creating new label in Todoist: %s", name)
+        l = self.labels.add(name)
+        self._stamp_commands('label:%s' % name, len(self.queue) - 1)
+        self._index('labels', l)
+        return l
+
+    def add_item(self, content, project_id, source=None, **kwargs):
+        """Queue an item for Todoist.
+
+        The note is added as well, referring to the item's temp_id.
+
+        :param list labels:
+            The list of labels to add to the item. Note that these should be the
+            name of the label and not its ID, as this is translated.
+
+        :param str source: What the item is created from, for giving the
+            commands stable uuids.
+
+        :rtype: todoist.models.Item
+        :return: The created item, with a temp_id until it's committed
+       
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Creating item: '%s', for project %s (%s), with "
+                         "args: %s", content, project_id,
+                         self.get_projectname(project_id), kwargs)
+        if kwargs.get('labels'):
+            kwargs['labels'] = [self.get_label_id_by_name(l) for l in
+                                kwargs['labels']]
+        else:
+            kwargs['labels'] = ()
+        notes = kwargs.get('notes')
+        # Add notes separately, after the item has been created
+        if 'notes' in kwargs:
+            del kwargs['notes']
+        start = len(self.queue)
+        it = self.items.add(content=content, project_id=project_id, **kwargs)
+        self._by_id['items'][it['id']] = it
+        if notes:
+            self.add_note(notes, item_id=it['id'])
+        self._stamp_commands(source, start)
+        return it
+
+    def update_item(self, item, source=None, **kwargs):
+        """Queue an update of an item in Todoist, and add its note.
+
+        The labels should be given by name, as in `add_item`. The source is
+        used for stable uuids, as in `add_item`.
+
+        """
+        logger.debug("Updating item %s: '%s', with args: %s", item['id'],
+                     item['content'], kwargs)
+        if 'labels' in kwargs:
+            kwargs['labels'] = [self.get_label_id_by_name(l) for l in
+                                kwargs['labels'] or ()]
+        notes = kwargs.pop('notes', None)
+        start = len(self.queue)
+        item.update(**kwargs)
+        if notes:
+            self.add_note(notes, item_id=item['id'])
+        self._stamp_commands(source, start)
+        return item
+
+    def move_item(self, item, project_id, source=None):
+        """Queue a move of an item to another project."""
+        logger.debug("Moving item %s to project %s", item['id'], project_id)
+        start = len(self.queue)
+        item.move(project_id)
+        self._stamp_commands(source, start)
+        return item
+
+    def complete_item(self, item, source=None):
+        """Queue the completion of an item, also if it repeats."""
+        logger.debug("Completing item %s: '%s'", item['id'], item['content'])
+        start = len(self.queue)
+        item.complete()
+        self._stamp_commands(source, start)
+        return item
+
+    def archive_project(self, project, source=None):
+        """Queue the archiving of a project."""
+        logger.debug("Archiving project %s: '%s'", project['id'],
+                     project['name'])
+        start = len(self.queue)
+        project.archive()
+        self._stamp_commands(source, start)
+        return project
+
+    def add_inbox_item(self, content, source=None):
+        """Add an item to Todoist's Inbox.
+        
+        This is a shortcut for a simple task, just adding something to the
+        Inbox. If you want so set some params, please see `add_item`.
+        
+        """
+        if not hasattr(self, '_inbox_id'):
+            self._inbox_id = self.get_project_id_by_name('Inbox')
+        return self.add_item(content=content, project_id = self._inbox_id,
+                             source=source)
+
+    def real_id(self, obj_id):
+        """Return the real Todoist id for a temp_id.
+
+        Ids that are not temp_ids, or temp_ids that are not committed yet, are
+        returned as they are.
+
+        """
+        return self.temp_ids.get(obj_id, obj_id)
+
+    def _resolve_temp_ids(self, commands):
+        """Replace already mapped temp_ids in the arguments of queued commands.
+
+        Todoist only resolves temp_ids within the same request, so commands
+        referring to objects created in an earlier batch must get the real ids.
+
+        """
+        for cmd in commands:
+            args = cmd.get('args', {})
+            for key in ('id', 'project_id', 'item_id', 'parent_id',
+                        'to_project'):
+                if key in args:
+                    args[key] = self.real_id(args[key])
+            for key in ('labels', 'ids'):
+                if args.get(key):
+                    args[key] = [self.real_id(i) for i in args[key]]
+            if args.get('project_items'):
+                # item_move has the projects of the items as keys
+                args['project_items'] = dict(
+                        (self.real_id(project_id),
+                         [self.real_id(i) for i in item_ids])
+                        for project_id, item_ids in
+                        args['project_items'].iteritems())
+
+    @staticmethod
+    def _command_refs(args):
+        """Return the ids and temp_ids that a command's arguments refer to."""
+        refs = [args.get(k) for k in ('id', 'project_id', 'item_id',
+                                      'parent_id', 'to_project')]
+        refs.extend(args.get('labels') or ())
+        refs.extend(args.get('ids') or ())
+        for project_id, item_ids in (args.get('project_items') or
+                                     {}).iteritems():
+            refs.append(project_id)
+            refs.extend(item_ids)
+        return [r for r in refs if r is not None]
+
+    def _skip_acked(self, commands):
+        """Drop the commands that the ledger says Todoist already has applied.
+
+        The temp_ids of dropped commands are mapped to the ids that Todoist gave
+        them the first time, and the commit listeners are told about them, as
+        if they were committed now.
+
+        If what a command created is no longer in Todoist, e.g. as it's been
+        deleted there, the command is sent once more. It then gets a uuid
+        derived from the first one, as Todoist would ignore the same uuid.
+
+        """
+        ret = []
+        skipped = []
+        mapping = {}
+        for cmd in commands:
+            cmd_uuid = cmd['uuid']
+            while (self.ledger.is_acked(cmd_uuid) and
+                   not self._acked_target_exists(cmd, cmd_uuid)):
+                cmd_uuid = self.stable_uuid(cmd_uuid)
+            if not self.ledger.is_acked(cmd_uuid):
+                cmd['uuid'] = cmd_uuid
+                ret.append(cmd)
+                continue
+            skipped.append(cmd)
+            todoist_id = self.ledger.acked_id(cmd_uuid)
+            if cmd.get('temp_id') and todoist_id is not None:
+                mapping[cmd['temp_id']] = todoist_id
+                self.temp_ids[cmd['temp_id']] = todoist_id
+                self._replace_temp_id(cmd['temp_id'], todoist_id)
+        if skipped:
+            logger.debug("Skipping %d commands already acknowledged",
+                         len(skipped))
+            for listener in self.commit_listeners:
+                listener(skipped, {'temp_id_mapping': mapping})
+        return ret
+
+    def _acked_target_exists(self, cmd, uuid):
+        """Return True if what an acknowledged command created is in Todoist.
+
+        Only commands that create objects are checked, by the id indexes.
+
+        """
+        todoist_id = self.ledger.acked_id(uuid)
+        if not cmd.get('temp_id') or todoist_id is None:
+            return True
+        kind = cmd['type'].rsplit('_', 1)[0] + 's'
+        if kind == 'notes' and cmd.get('args', {}).get('project_id'):
+            kind = 'project_notes'
+        if kind not in self._by_id:
+            return True
+        return todoist_id in self._by_id[kind]
+
+    def commit_if_full(self):
+        """Commit the queue if it has enough batches for all connections."""
+        if len(self.queue) >= self.batch_size * self.concurrency:
+            return self.commit()
+
+    @staticmethod
+    def command_size(command):
+        """Return the number of bytes the command takes in a request.
+
+        The commands are sent JSON encoded in a form, so this is the size after
+        both encodings.
+
+        """
+        return len(urllib.quote_plus(json.dumps(command)))
+
+    def _split_batches(self, commands):
+        """Generate batches of the commands, in order.
+
+        Each batch has max `batch_size` commands, and max `max_request_size`
+        bytes of commands, see `command_size`. A command that is bigger than
+        the limit on its own is sent alone.
+
+        :return: Tuples of the batch and its size in bytes.
+
+        """
+        batch = []
+        size = 0
+        for cmd in commands:
+            cmd_size = self.command_size(cmd)
+            if batch and (len(batch) >= self.batch_size or
+                          size + cmd_size > self.max_request_size):
+                yield batch, size
+                batch = []
+                size = 0
+            if cmd_size > self.max_request_size:
+                logger.warn("Command %s is %d bytes, more than the max "
+                            "request size", cmd.get('type'), cmd_size)
+            batch.append(cmd)
+            size += cmd_size
+        if batch:
+            yield batch, size
+
+    def commit(self):
+        """Commit the queue in batches of max `batch_size` commands.
+
+        The batches are also kept within `max_request_size` bytes.
+
+        :rtype: dict
+        :return: The response from the last batch
+
+        """
+        with metrics.span('commit', commands=len(self.queue)):
+            return self._commit()
+
+    def _commit(self):
+        pending = self.queue[:]
+        del self.queue[:]
+        if self.ledger is not None:
+            pending = self._skip_acked(pending)
+        if self.concurrency > 1 and len(pending) > self.batch_size:
+            return self._commit_concurrently(pending)
+        ret = None
+        for batch, size in list(self._split_batches(pending)):
+            del pending[:len(batch)]
+            self._resolve_temp_ids(batch)
+            self.queue.extend(batch)
+            try:
+                with metrics.span('batch', commands=len(batch), bytes=size):
+                    ret = self._commit_batch(size)
+            except CommitException, e:
+                # Put back what's not applied, in case the caller wants to retry
+                self.queue[:] = e.commands + pending
+                raise
+            except:
+                # The request failed, so the batch is still in the queue
+                self.queue.extend(pending)
+                raise
+        return ret
+
+    def _commit_batch(self, size=None):
+        """Commit and check feedback and raise Exception.
+
+        This is for easier code, rasising errors if something is wrong. Request
+        limits are handled by `sync`.
+
+        :param int size: The bytes of the queued commands, if already known.
+
+        """
+        sent = self.queue[:]
+        self._log_payload("Sending commands to Todoist", sent,
+                          summarize_commands)
+        for listener in self.send_listeners:
+            listener(sent)
+        # As the library's commit, but with the size for the metrics
+        ret = self.sync(commands=sent, size=size)
+        del self.queue[:]
+        self._log_payload("Commit response", ret, summarize_response)
+        return self._check_commit(sent, ret)
+
+    def _log_payload(self, what, payload, summarize):
+        """Log a summary of the payload, or a sample of them in full.
+
+        The full payloads are big, and slow to format, so they are only logged
+        for a share of the requests, see `payload_log_rate`.
+
+        """
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+        if self.payload_log_rate and random.random() < self.payload_log_rate:
+            logger.debug("%s: %s", what, json.dumps(payload))
+        else:
+            logger.debug("%s: %s", what, summarize(payload))
+
+    def _check_commit(self, sent, ret):
+        """Raise CommitException if Todoist failed any of the sent commands.
+
+        The commit listeners are told about the commands that Todoist did
+        apply, also when others failed. The failed commands are given with the
+        exception, so that only those are retried.
+
+        """
+        errors = {}
+        if isinstance(ret, dict):
+            if 'error' in ret:
+                logger.error("Error from Todoist: %s", ret)
+                raise CommitException('Commit to Todoist failed', ret, sent)
+            rows = ret.items() + (ret.get('sync_status') or {}).items()
+            for key, row in rows:
+                if isinstance(row, dict) and 'error' in row:
+                    logger.error("Errors from Todoist: %s: %s", key, row)
+                    errors[key] = row
+        failed = set(cmd['uuid'] for cmd in sent) & set(errors)
+        if errors and not failed:
+            # The errors are not by command, so none of them can be trusted
+            failed = set(cmd['uuid'] for cmd in sent)
+        applied = [cmd for cmd in sent if cmd['uuid'] not in failed]
+        if applied:
+            for listener in self.commit_listeners:
+                listener(applied, ret)
+        if errors:
+            raise CommitException('Commit to Todoist failed, %d errors' %
+                                  len(errors), errors,
+                                  [cmd for cmd in sent if cmd['uuid'] in failed])
+        return ret
+
+    def _dependency_levels(self, commands):
+        """Group commands so that each only depends on earlier groups.
+
+        A command depends on the earlier commands for the same objects, e.g. a
+        note on the command creating its item, or a move on the command
+        creating the project it moves to. The order within a group is kept.
+
+        :rtype: list
+        :return: Lists of commands
+
+        """
+        levels = []
+        # The level of the last command for each object id or temp_id
+        touched = {}
+        for cmd in commands:
+            args = cmd.get('args', {})
+            refs = self._command_refs(args)
+            level = max([touched[r] + 1 for r in refs if r in touched] or [0])
+            # The objects that the command changes
+            objs = [cmd.get('temp_id') or args.get('id')]
+            objs.extend(args.get('ids') or ())
+            for item_ids in (args.get('project_items') or {}).itervalues():
+                objs.extend(item_ids)
+            for obj_id in objs:
+                if obj_id is not None:
+                    touched[obj_id] = level
+            if level == len(levels):
+                levels.append([])
+            levels[level].append(cmd)
+        return levels
+
+    def _post_commands(self, commands):
+        """Send commands to Todoist, without touching the local state.
+
+        This is safe to call from several threads at once.
+
+        """
+        data = {'token': self.token, 'commands': json.dumps(commands),
+                'resource_types': '[]'}
+        return self._request(lambda: self._post('sync', data=data))
+
+    def _commit_concurrently(self, commands):
+        """Commit commands with up to `concurrency` batches in flight.
+
+        The commands are sent in their dependency order, see
+        `_dependency_levels`, so e.g. all projects before their items, and all
+        items before their notes. Within each level, batches are sent by a pool
+        of threads, while the responses are handled here as they arrive.
+
+        :rtype: dict
+        :return: The response from the last batch
+
+        """
+        ret = None
+        levels = self._dependency_levels(commands)
+        for i, level in enumerate(levels):
+            jobs = Queue.Queue()
+            results = Queue.Queue()
+            batches = 0
+            for batch, size in self._split_batches(level):
+                self._resolve_temp_ids(batch)
+                for listener in self.send_listeners:
+                    listener(batch)
+                jobs.put((batch, size))
+                batches += 1
+
+            def work():
+                while True:
+                    try:
+                        batch, size = jobs.get_nowait()
+                    except Queue.Empty:
+                        return
+                    try:
+                        with metrics.span('batch', commands=len(batch),
+                                          bytes=size):
+                            response = self._post_commands(batch)
+                        results.put((batch, response, None))
+                    except Exception, e:
+                        results.put((batch, None, e))
+
+            workers = [threading.Thread(target=work) for _ in
+                       xrange(min(self.concurrency, batches))]
+            for w in workers:
+                w.daemon = True
+                w.start()
+            error = None
+            failed = []
+            for _ in xrange(batches):
+                batch, response, e = results.get()
+                if e is None:
+                    try:
+                        ret = self._apply_commit_response(batch, response)
+                    except CommitException, e:
+                        pass
+                if e is not None:
+                    failed.extend(e.commands if isinstance(e, CommitException)
+                                  else batch)
+                    if error is None:
+                        error = e
+            for w in workers:
+                w.join()
+            if error is not None:
+                # Put back what's not applied, in case the caller wants to retry
+                self.queue.extend(failed)
+                for later in levels[i + 1:]:
+                    self.queue.extend(later)
+                raise error
+        return ret
+
+    def _apply_commit_response(self, batch, response):
+        """Update the local state from a response to `_post_commands`."""
+        self._log_payload("Commit response", response, summarize_response)
+        if isinstance(response, dict) and response.get('temp_id_mapping'):
+            mapping = response['temp_id_mapping']
+            for temp_id, new_id in mapping.iteritems():
+                self.temp_ids[temp_id] = new_id
+                self._replace_temp_id(temp_id, new_id)
+        return self._check_commit(batch, response)
+
+    # The parts of the state that are cached, and their models
+    _cached_state = {'projects': 'Project', 'items': 'Item', 'labels': 'Label',
+                     'notes': 'Note', 'project_notes': 'ProjectNote'}
+
+    def _state_owner(self):
+        """Return a digest of the API token, to know whose state is cached."""
+        return hashlib.md5(self.token).hexdigest()
+
+    def load_state(self, filename):
+        """Load the local state and sync_token cached by `save_state`.
+
+        The next `sync` is then incremental, only getting what has changed in
+        Todoist since the state was cached.
+
+        :rtype: bool
+        :return: True if the state was loaded, False if there was no usable
+            cache for this account.
+
+        """
+        try:
+            f = open(filename)
+        except IOError:
+            return False
+        try:
+            cache = json.load(f)
+        except ValueError, e:
+            logger.warn("Ignoring broken state cache %s: %s", filename, e)
+            return False
+        finally:
+            f.close()
+        if cache.get('owner') != self._state_owner():
+            logger.debug("State cache %s is for another account", filename)
+            return False
+        for name, model in self._cached_state.iteritems():
+            if name not in cache['state']:
+                continue
+            cls = getattr(todoist.models, model)
+            self.state[name] = [cls(data, self) for data in
+                                cache['state'][name]]
+        self.sync_token = cache['sync_token']
+        self._build_indexes()
+        logger.debug("Loaded state from %s", filename)
+        return True
+
+    def save_state(self, filename):
+        """Cache the local state and sync_token in a file, for later runs."""
+        if self.queue:
+            logger.warn("Not caching the state, uncommitted commands in queue")
+            return
+        cache = {'owner': self._state_owner(), 'sync_token': self.sync_token,
+                 'state': dict((name, [obj.data for obj in self.state[name]])
+                               for name in self._cached_state
+                               if name in self.state)}
+        tmp = filename + '.tmp'
+        f = open(tmp, 'w')
+        try:
+            json.dump(cache, f)
+        finally:
+            f.close()
+        os.rename(tmp, filename)
+        logger.debug("Saved state to %s", filename)
+
+    def get_max_project_position(self):
+        """Get the max `item_order` set in Todoist for projects."""
+        return max([p.data.get('item_order', 0) for p in self.projects.all()] or
+                   [0])
+
+class ExportPlan:
+
+    """A plan of what to export to Todoist.
+
+    The plan is made from the Doit data and the local state of Todoist, without
+    touching the network, so the size of the export is known before it starts.
+    It is a list of operations, in the order they should be applied. Each
+    operation is a dict with:
+
+    - op (str): 'create', 'update' or 'skip'. Tasks could also be moved to
+      another project with 'move' or completed with 'complete', and projects
+      archived with 'archive'.
+    - kind (str): 'label', 'project' or 'task'
+    - key (str): What the operation is for, e.g. 'project:Doit.im'
+    - depends (list): The keys of the operations that must be applied first,
+      since this operation refers to what they create
+    - args (dict): The details for creating or updating the object
+
+    The plan is plain data, so it could be saved as JSON.
+
+    """
+
+    def __init__(self, operations=None):
+        self.operations = operations or []
+        self._keys = set(op['key'] for op in self.operations)
+
+    def add(self, op, kind, key, args=None, depends=()):
+        """Add an operation to the plan.
+
+        :rtype: str
+        :return: The key of the operation
+
+        """
+        self.operations.append({'op': op, 'kind': kind, 'key': key,
+                                'args': args or {}, 'depends': list(depends)})
+        self._keys.add(key)
+        return key
+
+    def has(self, key):
+        """Return True if the plan has an operation with the given key."""
+        return key in self._keys
+
+    def counts(self):
+        """Return the number of operations per kind and op."""
+        ret = {}
+        for op in self.operations:
+            kind = ret.setdefault(op['kind'], {})
+            kind[op['op']] = kind.get(op['op'], 0) + 1
+        return ret
+
+    @staticmethod
+    def count_operation_commands(op):
+        """Return the max number of Todoist commands for an operation."""
+        if op['op'] == 'skip':
+            return 0
+        n = 1
+        notes = op['args'].get('notes')
+        if notes:
+            # Long notes are split, see TodoistHelperAPI.split_note
+            n += len(notes.strip()) // TodoistHelperAPI._max_len_request_uri + 1
+        if op['args'].get('repeater'):
+            # The inbox item about the unhandled repeater
+            n += 1
+        return n
+
+    def count_commands(self):
+        """Return the max number of Todoist commands for the whole plan."""
+        return sum(self.count_operation_commands(op) for op in self.operations)
+
+    def estimate_commits(self, batch_size):
+        """Return the number of commits needed for the plan."""
+        commands = self.count_commands()
+        return (commands + batch_size - 1) // batch_size
+
+    def print_status(self, batch_size, per_minute):
+        """Print the size of the plan."""
+        for kind, ops in sorted(self.counts().iteritems()):
+            for op, n in sorted(ops.iteritems()):
+                print "%7d %ss to %s" % (n, kind, op)
+        commands = self.count_commands()
+        commits = self.estimate_commits(batch_size)
+        print("Estimated %d commands in %d commits, taking at least %.1f "
+              "minutes at %d requests per minute" % (commands, commits,
+                                                     commits / float(per_minute),
+                                                     per_minute))
+
+    def save(self, filename):
+        """Save the plan as JSON."""
+        f = open(filename, 'w')
+        try:
+            json.dump({'operations': self.operations}, f, indent=1)
+        finally:
+            f.close()
+
+    @classmethod
+    def load(cls, filename):
+        """Load a plan saved by `save`."""
+        f = open(filename)
+        try:
+            return cls(json.load(f)['operations'])
+        finally:
+            f.close()
+
+class Todoist_exporter:
+
+    """ Class that handles the export to Todoist.
+
+    The export is done in two steps. First `plan` figures out what to create,
+    update or skip, by comparing the Doit data with the local state of
+    Todoist. Then `apply` executes the plan against Todoist.
+
+    """
 
     # Name of the super project that all the projects should be put underneath
     # in Todoist:
@@ -539,31 +2624,349 @@ class Todoist_exporter:
 
     inboxproject_name = 'Inbox'
 
-    def __init__(self, doit, tdst):
+    def __init__(self, doit, tdst, idmap=None, since_usn=None):
         self.doit = doit
         self.tdst = tdst
+        self.idmap = idmap
+        # In delta mode, only what's changed after this usn is exported, and
+        # what's removed from Doit is completed or archived in Todoist
+        self.since_usn = since_usn
+        # The API could be reused by several exporters with the same map
+        if idmap and idmap.queued not in tdst.send_listeners:
+            tdst.send_listeners.append(idmap.queued)
+            tdst.commit_listeners.append(idmap.committed)
+            tdst.ledger = idmap
+
+    def resume(self):
+        """Send the commands that an interrupted export left unacknowledged.
+
+        The commands are sent again as they were, with the same uuids, and
+        with temp_ids from earlier batches mapped to what Todoist gave them. The
+        Doit objects they are for get mapped when the commands are committed.
+
+        :rtype: int
+        :return: The number of commands sent again
+
+        """
+        commands = self.idmap.unacked()
+        if not commands:
+            return 0
+        logger.info("Resuming export, sending %d unacknowledged commands",
+                    len(commands))
+        self.tdst.temp_ids.update(self.idmap.journal_temp_ids())
+        for cmd, kind, doit_id, fp in commands:
+            if doit_id:
+                self.idmap.add(kind, doit_id,
+                               self.idmap.command_object_id(cmd), fp)
+            self.tdst.queue.append(cmd)
+        self.tdst.commit()
+        return len(commands)
 
     def export(self):
         """Do the full export to Todoist"""
         logger.debug("Start export from Doit to Todoist")
-        self.tdst.sync()
-        self.tdst.items.sync()
-        self.tdst.projects.sync()
-        self.tdst.labels.sync()
-        self.tdst.notes.sync()
+        if self.tdst.sync_token == '*':
+            # Not synced at all yet
+            self.tdst.sync()
         logger.debug("Status in Todoist: %d projects, %d items, %d labels, "
                      "%d notes", len(self.tdst.projects.all()),
                      len(self.tdst.items.all()), len(self.tdst.labels.all()),
                      len(self.tdst.notes.all()))
-        self.export_labels()
-        self.export_projects()
-        self.export_tasks()
-        # Not really needed, but just to be sure
-        self.tdst.commit()
+        self.apply(self.plan())
+        if self.idmap:
+            self.idmap.clear_journal()
+            self.idmap.set_high_water_usn(self.doit.max_usn())
         logger.debug("Export from Doit to Todoist done")
 
-    def export_labels(self):
-        """Export all labels to Todoist.
+    # The columns in Todoist's CSV templates
+    template_columns = ('TYPE', 'CONTENT', 'PRIORITY', 'INDENT', 'AUTHOR',
+                        'RESPONSIBLE', 'DATE', 'DATE_LANG', 'TIMEZONE')
+
+    def export_templates(self, directory):
+        """Write the tasks as Todoist templates, one CSV file per project.
+
+        This is an offline alternative to `export`. The templates could be
+        imported into Todoist's projects by hand, which doesn't count against
+        the request limits. Each file is written one task at a time, so the
+        rows are never all in memory.
+
+        A `manifest.json` lists the files with the project and parent project
+        they are for, the number of tasks and notes, the labels that are used,
+        and the tasks that repeat in a way that must be set manually. It also
+        lists the tasks in projects that are not active, which are written to
+        the super project's template.
+
+        :param str directory: Where to put the files. Created if missing.
+        :rtype: dict
+        :return: The manifest.
+
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        manifest = {'projects': [], 'labels': set(),
+                    'unhandled_repeaters': []}
+        now = time.time() * 1000
+        meta = ('inbox', 'noplan')
+        projects = self.doit.list_active_projects()
+        active = set(pr['uuid'] for pr in projects)
+        # Tasks in projects that are not active go with the tasks without a
+        # project, instead of getting lost
+        orphans = [t['title'] for t in self.doit.list_active_tasks()
+                   if 'project' in t and t['project'] not in active and
+                   t['attribute'] not in meta]
+        if orphans:
+            logger.warn("%d tasks are in projects that are not active, "
+                        "writing them to the template of %s", len(orphans),
+                        self.superproject_name)
+        manifest['tasks_without_project'] = orphans
+        sources = [
+            (self.inboxproject_name, None, self.doit.query(attribute='inbox')),
+            (self.somedayproject_name, None,
+             self.doit.query(attribute='noplan')),
+            (self.superproject_name, None,
+             (t for t in self.doit.list_active_tasks()
+              if t.get('project') not in active and
+              t['attribute'] not in meta))]
+        for pr in projects:
+            sources.append((pr['name'], self.superproject_name,
+                            (t for t in self.doit.query(project=pr['uuid'])
+                             if t['attribute'] not in meta)))
+
+        with metrics.span('templates') as span:
+            for i, (name, parent, tasks) in enumerate(sources):
+                filename = '%03d-%s.csv' % (i, re.sub(r'(?u)[^\w.-]+', '_',
+                                                      name).strip('_'))
+                # The due dates are found per project, so that only one
+                # project's dates are kept at a time
+                tasks = list(tasks)
+                due_dates = self.calculate_due_dates(tasks, now)
+                entry = self._write_template(os.path.join(directory, filename),
+                                             tasks, due_dates, manifest)
+                if not entry['tasks'] and parent is None:
+                    # No need for empty meta projects
+                    os.remove(os.path.join(directory, filename))
+                    continue
+                entry.update(name=name, parent=parent, file=filename)
+                manifest['projects'].append(entry)
+            span['files'] = len(manifest['projects'])
+            span['tasks'] = sum(p['tasks'] for p in manifest['projects'])
+
+        manifest['labels'] = sorted(manifest['labels'])
+        with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        print("Wrote %d templates with %d tasks to %s" %
+              (len(manifest['projects']),
+               sum(p['tasks'] for p in manifest['projects']), directory))
+        return manifest
+
+    def _write_template(self, filename, tasks, due_dates, manifest):
+        """Write the given tasks to a Todoist CSV template.
+
+        :rtype: dict
+        :return: The number of tasks and notes written.
+
+        """
+        def encode(row):
+            return [unicode(c).encode('utf-8') for c in row]
+
+        entry = {'tasks': 0, 'notes': 0}
+        with open(filename, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(self.template_columns)
+            for task in tasks:
+                labels = self.task_labels(task)
+                manifest['labels'].update(labels)
+                date_str, due_str, unhandled = self.task_dates(
+                                                task, due_dates[task['id']])
+                if unhandled:
+                    manifest['unhandled_repeaters'].append(task['title'])
+                if date_str == 'someday':
+                    # Templates only take a date string
+                    date_str = due_str[:10]
+                elif date_str and due_str and ' starting ' not in date_str:
+                    # Without a due date next to it, the repeater starts at
+                    # the next occurrence
+                    date_str = '%s starting %s' % (date_str, due_str[:10])
+                content = ' '.join([task['title']] +
+                                   ['@%s' % l for l in labels])
+                # Todoist's priority 1 is the most urgent, as in its GUI
+                writer.writerow(encode(('task', content, 4 - task['priority'],
+                                        1, '', '', date_str, 'en', '')))
+                entry['tasks'] += 1
+                if task.get('notes'):
+                    writer.writerow(encode(('note', task['notes'], '', '',
+                                            '', '', '', '', '')))
+                    entry['notes'] += 1
+        return entry
+
+    def plan(self):
+        """Plan the full export, without touching the network.
+
+        :rtype: ExportPlan
+
+        """
+        plan = ExportPlan()
+        kinds = ('labels', 'projects', 'tasks')
+        if self.since_usn is not None and self.idmap:
+            kinds += ('removals',)
+        for kind in kinds:
+            with metrics.span('plan_%s' % kind) as span:
+                before = len(plan.operations)
+                getattr(self, 'plan_%s' % kind)(plan)
+                span['operations'] = len(plan.operations) - before
+        logger.debug("Planned export: %s", plan.counts())
+        return plan
+
+    def apply(self, plan):
+        """Export to Todoist what the plan says.
+
+        Each operation is applied by the method `_apply_<op>_<kind>`. The time
+        spent on each kind is recorded in `metrics`, e.g. "apply_tasks".
+
+        """
+        # The Todoist objects created by the plan, by their operation key
+        self._created = {}
+        # Items with repeaters that must be fixed manually. The inbox items
+        # about them are created when the items have got their real ids.
+        self._unhandled_repeaters = []
+        kind = None
+        for op in plan.operations:
+            if op['kind'] != kind:
+                if kind:
+                    metrics.record('apply_%ss' % kind, time.time() - start,
+                                   operations=done)
+                kind = op['kind']
+                start = time.time()
+                done = 0
+            self.tdst.commit_if_full()
+            if op['op'] == 'skip':
+                self._apply_skip(op)
+            else:
+                getattr(self, '_apply_%s_%s' % (op['op'], op['kind']))(op)
+            done += 1
+        if kind:
+            metrics.record('apply_%ss' % kind, time.time() - start,
+                           operations=done)
+        if self.idmap:
+            self.idmap.flush()
+        self.tdst.commit()
+        for item, repeater, source in self._unhandled_repeaters:
+            self.tdst.add_inbox_item("New item missing repeat date: "
+                        "https://todoist.com/showTask?id=%s - please "
+                        "fix: %s" % (self.tdst.real_id(item['id']), repeater),
+                        source='%s:repeater' % source)
+        self.tdst.commit()
+
+    @staticmethod
+    def _source(op):
+        """Return what identifies the operation, for stable command uuids.
+
+        The fingerprint is included, so that a changed Doit object gives new
+        commands.
+
+        """
+        return '%s:%s' % (op['key'], op['args'].get('fingerprint', ''))
+
+    def _map(self, kind, args, todoist_id):
+        """Map the Doit object of an operation to its Todoist object."""
+        if self.idmap and args.get('doit_id'):
+            self.idmap.add(kind, args['doit_id'], todoist_id,
+                           args['fingerprint'])
+
+    def _apply_skip(self, op):
+        args = op['args']
+        if self.idmap and args.get('doit_id'):
+            # An existing object, mapped for the first time. It's written
+            # to the database at the end of `apply`, not one by one.
+            self.idmap.set(op['kind'], args['doit_id'], args['todoist_id'],
+                           args['fingerprint'], commit=False)
+
+    def _apply_create_label(self, op):
+        name = op['args']['name']
+        print "Creating label: %s" % name
+        self._created[op['key']] = self.tdst.add_label(name)
+
+    def _apply_create_project(self, op):
+        args = op['args']
+        print "Creating project: %s" % args['name']
+        kwargs = dict((k, args[k]) for k in ('indent', 'item_order', 'notes')
+                      if args.get(k) is not None)
+        project = self.tdst.add_project(args['name'], source=self._source(op),
+                                        **kwargs)
+        self._created[op['key']] = project
+        self._map('project', args, project['id'])
+
+    def _apply_update_project(self, op):
+        args = op['args']
+        project = self.tdst.get_project(args['todoist_id'])
+        changes = dict((k, args[k]) for k in ('name', 'indent', 'item_order')
+                       if k in args)
+        if changes:
+            self.tdst.update_project(project, source=self._source(op),
+                                     **changes)
+        if args.get('notes'):
+            self.tdst.add_note(args['notes'], project_id=project['id'],
+                               source=self._source(op) + ':note')
+        self._map('project', args, project['id'])
+
+    def _apply_archive_project(self, op):
+        args = op['args']
+        project = self.tdst.get_project(args['todoist_id'])
+        print "Archiving project: %s" % project['name']
+        self.tdst.archive_project(project, source=self._source(op))
+        self.idmap.remove('project', args['doit_id'],
+                          self.tdst.queue[-1]['uuid'])
+
+    def _get_project_id(self, args):
+        """Return the project id of a task operation."""
+        if 'project_ref' in args:
+            return self._created[args['project_ref']]['id']
+        return args['project_id']
+
+    def _apply_create_task(self, op):
+        args = op['args']
+        print "Creating task: %s" % args['content']
+        item = self.tdst.add_item(content=args['content'],
+                                  project_id=self._get_project_id(args),
+                                  indent=1, item_order=args['item_order'],
+                                  priority=args['priority'],
+                                  date_string=args['date_string'],
+                                  due_date_utc=args['due_date_utc'],
+                                  labels=args['labels'], notes=args['notes'],
+                                  source=self._source(op))
+        self._map('task', args, item['id'])
+        if args.get('repeater'):
+            self._unhandled_repeaters.append((item, args['repeater'],
+                                              self._source(op)))
+
+    def _apply_update_task(self, op):
+        args = op['args']
+        print "Updating task: %s" % args['content']
+        item = self.tdst.get_item(args['todoist_id'])
+        self.tdst.update_item(item, content=args['content'],
+                              priority=args['priority'],
+                              date_string=args['date_string'],
+                              due_date_utc=args['due_date_utc'],
+                              labels=args['labels'], notes=args['notes'],
+                              source=self._source(op))
+        self._map('task', args, item['id'])
+
+    def _apply_move_task(self, op):
+        args = op['args']
+        item = self.tdst.get_item(args['todoist_id'])
+        print "Moving task: %s" % item['content']
+        self.tdst.move_item(item, self._get_project_id(args),
+                            source=self._source(op))
+
+    def _apply_complete_task(self, op):
+        args = op['args']
+        item = self.tdst.get_item(args['todoist_id'])
+        print "Completing task: %s" % item['content']
+        self.tdst.complete_item(item, source=self._source(op))
+        self.idmap.remove('task', args['doit_id'], self.tdst.queue[-1]['uuid'])
+
+    def plan_labels(self, plan):
+        """Plan the export of all labels to Todoist.
 
         It fetches Contexts and Tags from the Doit data and creates them in
         Todoist as Labels. Some labels are used in the sync and are therefore
@@ -573,18 +2976,21 @@ class Todoist_exporter:
         names = set(self.doit.list_context_names().keys())
         names.update(self.doit.list_tag_names().keys())
         names.add('waiting')
-        existing = [l['name'] for l in self.tdst.labels.all()]
-        for name in names:
+        for name in sorted(names):
             logger.debug("Prosessing Doit context or tag: %s", name)
-            if name in existing:
-                continue
-            print "Creating label: %s" % name
-            logger.debug("Creating new label in Todoist: %s", name)
-            self.tdst.labels.add(name)
-            self.tdst.commit()
+            op = 'skip' if self.tdst.has_label(name) else 'create'
+            plan.add(op, 'label', 'label:%s' % name, {'name': name})
+
+    def _plan_meta_project(self, plan, name):
+        """Plan one of the meta projects, if it doesn't exist."""
+        try:
+            return self.tdst.get_project_by_name(name)
+        except NotFoundException:
+            plan.add('create', 'project', 'project:%s' % name, {'name': name})
+            return None
 
-    def export_projects(self):
-        """Export all projects to Todoist.
+    def plan_projects(self, plan):
+        """Plan the export of all projects to Todoist.
 
         All projects from Doit are created in Todoist as regular projects. This
         might not be what you want.
@@ -601,32 +3007,89 @@ class Todoist_exporter:
         projects = self.doit.list_active_projects()
         
         # Create the meta projects:
-        somedaypr = self.tdst.assert_and_get_project(self.somedayproject_name)
-        superpr = self.tdst.assert_and_get_project(self.superproject_name)
+        self._plan_meta_project(plan, self.somedayproject_name)
+        superpr = self._plan_meta_project(plan, self.superproject_name)
         # The projects must be positioned underneath the super project:
-        if 'item_order' in superpr.data:
+        if superpr is not None and 'item_order' in superpr.data:
             super_pos = superpr['item_order']
             logger.debug("Setting project's item_order: %s", super_pos)
         else:
             super_pos = self.tdst.get_max_project_position() + 1
             logger.debug("Setting project's item_order to max: %s", super_pos)
-
-        super_indent = superpr.data.get('indent', 1)
+        super_indent = 1
+        depends = ['project:%s' % self.superproject_name]
+        if superpr is not None:
+            super_indent = superpr.data.get('indent', 1)
+            depends = []
 
         # The returned list is sorted
         for pr in projects:
             logger.debug("Processing Doit project: %s", pr)
             name = pr['name']
-            created = self.tdst.assert_project(pr['name'],
-                                               indent=super_indent + 1,
-                                               item_order=super_pos,
-                                               notes=pr.get('notes'))
-            if created:
-                print "Created project: %s" % pr['name']
+            key = 'project:%s' % name
+            args = {'name': name, 'indent': super_indent + 1,
+                    'item_order': super_pos, 'notes': pr.get('notes'),
+                    'doit_id': pr['uuid'],
+                    'fingerprint': IdentityMap.fingerprint(pr)}
+            project = None
+            known = self.idmap and self.idmap.get('project', pr['uuid'])
+            if known:
+                project = self.tdst.get_project(known[0])
+                if project is not None:
+                    args['todoist_id'] = project['id']
+                    if known[1] == args['fingerprint']:
+                        if self.since_usn is not None:
+                            # Nothing to do in delta mode
+                            continue
+                        plan.add('skip', 'project', key, {'todoist_id':
+                                                          project['id']})
+                    else:
+                        del args['indent'], args['item_order']
+                        plan.add('update', 'project', key, args)
+                    continue
+            try:
+                project = self.tdst.get_project_by_name(name)
+            except NotFoundException:
+                plan.add('create', 'project', key, args, depends)
                 super_pos += 1
+                continue
+            # An existing project with the same name
+            args['todoist_id'] = project['id']
+            del args['name']
+            for k in ('indent', 'item_order'):
+                if project.data.get(k) == args[k]:
+                    del args[k]
+            if args['notes'] and self.tdst.has_note(args['notes'],
+                                                    project_id=project['id']):
+                args['notes'] = None
+            if 'indent' in args or 'item_order' in args or args['notes']:
+                plan.add('update', 'project', key, args)
+            else:
+                plan.add('skip', 'project', key, args)
+
+    def _plan_project_ref(self, plan, task, prname):
+        """Return how a task operation refers to the task's project.
 
-    def export_tasks(self):
-        """Export all Doit tasks as Items in Todoist.
+        :rtype: dict
+        :return: Either the `project_id` of an existing Todoist project, or the
+            `project_ref` to the operation that creates the project. None if the
+            project is not found.
+
+        """
+        if task['attribute'] not in ('inbox', 'noplan') and 'project' in task:
+            known = self.idmap and self.idmap.get('project', task['project'])
+            if known and self.tdst.get_project(known[0]) is not None:
+                return {'project_id': known[0]}
+        try:
+            return {'project_id': self.tdst.get_project_id_by_name(prname)}
+        except NotFoundException:
+            key = 'project:%s' % prname
+            if plan.has(key):
+                return {'project_ref': key}
+        return None
+
+    def plan_tasks(self, plan):
+        """Plan the export of all Doit tasks as Items in Todoist.
 
         Some special handling is needed, as Doit and Todoist works a bit
         differently. A description of its behaviour:
@@ -634,7 +3097,7 @@ class Todoist_exporter:
         - Tasks without a project are put directly into the Doit super project
           in Todoist.
 
-        - Dates, see `self.calculate_due_date` for how it's set.
+        - Dates, see `self.calculate_due_dates` for how they're set.
 
         - Tasks set to Waiting are instead given the @waiting label, and are
           kept into its correct project.
@@ -642,84 +3105,165 @@ class Todoist_exporter:
         - The task's description is added as a Note.
 
         """
-        tasks = self.doit.list_active_tasks()
-        existing = [l['content'] for l in self.tdst.items.all()]
+        if self.since_usn is not None:
+            tasks = self.doit.changed_since(self.since_usn)
+            logger.info("Delta export of %d tasks changed since usn %s",
+                        len(tasks), self.since_usn)
+        else:
+            tasks = self.doit.list_active_tasks()
+        # Without any mapped tasks, the tasks could have been exported by an
+        # older version of this script, so existing items are matched by their
+        # content once, to adopt them.
+        existing = {}
+        if not self.idmap or not self.idmap.has_kind('task'):
+            existing = dict((i['content'], i) for i in self.tdst.items.all())
 
         # Positions are relative to the projects
         positions = {}
-
-        # TODO: Find project from Doit and match in Todoist
+        due_dates = self.calculate_due_dates(tasks)
 
         # The returned list is sorted
         for task in tasks:
             logger.debug("Processing Doit task: %s", task)
             name = task['title']
-            if name in existing:
+            key = 'task:%s' % task['id']
+            args = {'content': name, 'doit_id': task['id'],
+                    'fingerprint': IdentityMap.fingerprint(task)}
+            item = None
+            known = self.idmap and self.idmap.get('task', task['id'])
+            if known:
+                item = self.tdst.get_item(known[0])
+                if item is not None and known[1] == args['fingerprint']:
+                    logger.debug("Task unchanged since last export")
+                    plan.add('skip', 'task', key, {'todoist_id': item['id']})
+                    continue
+            elif name in existing:
                 # TODO: Handle updating existing tasks!
+                args['todoist_id'] = existing[name]['id']
+                plan.add('skip', 'task', key, args)
                 continue
-            print "Creating task: %s" % name
-
-            doit_project = None
-            if 'project' in task:
-                doit_project = self.doit.get_project(task['project'])
-
-            # Special treatment for tasks in the inbox and someday categories
-            if task['attribute'] == 'inbox':
-                prname = self.inboxproject_name
-            elif task['attribute'] == 'noplan':
-                prname = self.somedayproject_name
-            elif 'project' in task:
-                prname = self.doit.get_project_name(task['project'])
-            else:
-                prname = self.superproject_name
 
-            try:
-                prid = self.tdst.get_project_id_by_name(prname)
-            except KeyError:
+            prname = self.task_project_name(task)
+
+            depends = []
+            project = self._plan_project_ref(plan, task, prname)
+            if project is None:
                 print("Couldn't add task '%s' due to missing project '%s'"
                       % (name, prname))
                 continue
+            if 'project_ref' in project:
+                depends.append(project['project_ref'])
+            prid = project.values()[0]
             positions.setdefault(prid, 0)
             positions[prid] += 1
 
-            labels = set()
-            if 'tags' in task:
-                labels.update(task['tags'])
-            if 'context' in task:
-                labels.add(self.doit.get_context_name(task['context']))
-            # Add if the task is in Waiting mode, then the @waiting context is
-            # added:
-            if task['attribute'] == 'waiting':
-                labels.add('waiting')
-
-            # TODO: Check if recurring dates
-            date_str = ''
-            due_str = ''
-            repeater_unhandled = False
-            if 'repeater' in task:
-                try:
-                    date_str = self.generate_repeating_string(task['repeater'])
-                except UnhandledRepeaterError:
-                    # TODO: Add to inbox
-                    repeater_unhandled = True
-            if not date_str or 'repeater' not in task:
-                due_str = self.calculate_due_date(task, doit_project)
-                if due_str and not date_str:
-                    # Need to set date_string to something for Todoist to
-                    # recognise the due_date_utc to work, don't know why
-                    date_str = 'someday'
-            ret = self.tdst.add_item(content=name, project_id=prid, indent=1,
-                                     item_order=positions[prid],
-                                     priority=task['priority'] + 1,
-                                     date_string=date_str, due_date_utc=due_str,
-                                     labels=labels, notes=task.get('notes'))
-            if repeater_unhandled:
-                self.tdst.add_inbox_item("New item missing repeat date: "
-                            "https://todoist.com/showTask?id=%s - please "
-                            "fix: %s" % (ret['id'], task['repeater']))
-
-    def calculate_due_date(self, task, project):
-        """Figure out what due date to set in Todoist for a task.
+            labels = self.task_labels(task)
+            depends.extend('label:%s' % l for l in labels
+                           if not self.tdst.has_label(l))
+
+            date_str, due_str, unhandled = self.task_dates(
+                                                task, due_dates[task['id']])
+            if unhandled:
+                args['repeater'] = task['repeater']
+            args.update(priority=task['priority'] + 1, date_string=date_str,
+                        due_date_utc=due_str, labels=labels,
+                        notes=task.get('notes'))
+            if item is not None:
+                args['todoist_id'] = item['id']
+                args.pop('repeater', None)
+                plan.add('update', 'task', key, args, depends)
+                if project.get('project_id') != item['project_id']:
+                    move = dict(project, todoist_id=item['id'],
+                                fingerprint=args['fingerprint'])
+                    plan.add('move', 'task', key + ':move', move, depends)
+                continue
+            args.update(project, item_order=positions[prid])
+            plan.add('create', 'task', key, args, depends)
+
+    def plan_removals(self, plan):
+        """Plan what to do with the exported tasks and projects that are gone.
+
+        Only done in delta mode. Tasks that are completed, deleted or missing in
+        the new Doit data are completed in Todoist, and such projects are
+        archived. The Doit data must then be a full export, and not just some
+        of the tasks.
+
+        """
+        for doit_id in self.idmap.doit_ids('task'):
+            if self.doit.is_active_task(doit_id):
+                continue
+            item = self.tdst.get_item(self.idmap.get('task', doit_id)[0])
+            if item is None or item.data.get('checked'):
+                continue
+            plan.add('complete', 'task', 'task:%s' % doit_id,
+                     {'todoist_id': item['id'], 'doit_id': doit_id})
+        active = set(p['uuid'] for p in self.doit.list_active_projects())
+        for doit_id in self.idmap.doit_ids('project'):
+            if doit_id in active:
+                continue
+            project = self.tdst.get_project(self.idmap.get('project',
+                                                           doit_id)[0])
+            if project is None or project.data.get('is_archived'):
+                continue
+            plan.add('archive', 'project', 'project:%s:archive' % doit_id,
+                     {'todoist_id': project['id'], 'doit_id': doit_id})
+
+    def task_project_name(self, task):
+        """Return the name of the Todoist project that a task belongs in.
+
+        Tasks in the inbox and someday categories are put in the Inbox and the
+        Someday Maybe projects, and tasks without a project in the super
+        project.
+
+        """
+        if task['attribute'] == 'inbox':
+            return self.inboxproject_name
+        elif task['attribute'] == 'noplan':
+            return self.somedayproject_name
+        elif 'project' in task:
+            return self.doit.get_project_name(task['project'])
+        return self.superproject_name
+
+    def task_labels(self, task):
+        """Return the sorted names of the labels that a task should get.
+
+        Both tags and the context becomes labels, and tasks in Waiting mode
+        gets the @waiting label.
+
+        """
+        labels = set()
+        if 'tags' in task:
+            labels.update(task['tags'])
+        if 'context' in task:
+            labels.add(self.doit.get_context_name(task['context']))
+        if task['attribute'] == 'waiting':
+            labels.add('waiting')
+        return sorted(labels)
+
+    def task_dates(self, task, due_str):
+        """Return the date string and due date that a task should get.
+
+        :param str due_str: The task's due date, from `calculate_due_dates`.
+        :rtype: tuple
+        :return: The `date_string`, the `due_date_utc`, and True if the task
+            repeats in a way that could not be translated.
+
+        """
+        date_str = ''
+        unhandled = False
+        if 'repeater' in task:
+            try:
+                date_str = self.generate_repeating_string(task['repeater'])
+            except UnhandledRepeaterError:
+                unhandled = True
+        if due_str and not date_str:
+            # Need to set date_string to something for Todoist to
+            # recognise the due_date_utc to work, don't know why
+            date_str = 'someday'
+        return date_str, due_str or '', unhandled
+
+    def calculate_due_dates(self, tasks, now=None):
+        """Figure out what due dates to set in Todoist for the tasks.
 
         The problem is that Todoist only has one date, the "due date", while
         Doit has both a start and end date, in addition to the projects' own
@@ -740,28 +3284,38 @@ class Todoist_exporter:
 
         - No due date is set if no dates were found.
 
+        - Repeating tasks get their next occurrence from now, instead of their
+          first occurrence, which could be long ago. See `next_occurrences`.
+
+        :param list tasks: The Doit tasks.
+        :param float now: Milliseconds since epoch. Default: The current time.
+        :rtype: dict
+        :return: The due date per task id, or None if no date.
+
         """
-        if task['end_at']:
-            return timestamp_to_date(task['end_at'])
-        if task['start_at']:
-            return timestamp_to_date(task['start_at'])
-        if project:
-            if project['end_at']:
-                return timestamp_to_date(project['end_at'])
-            if project['start_at']:
-                return timestamp_to_date(project['start_at'])
-        return None
+        if now is None:
+            now = time.time() * 1000
+        firsts = array('d')
+        repeaters = []
+        for task in tasks:
+            first = task['end_at'] or task['start_at']
+            if not first and 'project' in task:
+                project = self.doit.get_project(task['project'])
+                first = project['end_at'] or project['start_at']
+            firsts.append(first or 0)
+            repeaters.append(task.get('repeater'))
+        nexts = next_occurrences(firsts, repeaters, now)
+        return dict((task['id'], timestamp_to_date(nxt) if nxt else None)
+                    for task, nxt in zip(tasks, nexts))
 
     def generate_repeating_string(self, rep):
         """Translate a Doit repeater into Todoist's human readable format.
 
-        Note that I take the liberty to use the form *after* instead of *every*
-        in the tasks. The difference is that the next task will occur the given
-        period after *completion* and not stuck in the schedule. You might need
-        to clean things up afterwards in the tasks.
+        See `translate_repeater` for the format. Each distinct repeater is
+        only translated once, as many tasks tend to repeat the same way.
 
-        The Doit format is just reverse engineered, so the translation is not
-        complete.
+        The Doit format is just reverse engineered, so the translation might
+        not be complete.
 
         Explanations for Todoist could be located at
         https://todoist.com/Help/DatesTimes.
@@ -769,90 +3323,599 @@ class Todoist_exporter:
         """
         if not rep:
             return ""
+        mode = rep.get('mode')
+        config = rep.get(mode) or {}
+        key = (mode, json.dumps(config, sort_keys=True))
+        if key not in _repeating_strings:
+            try:
+                _repeating_strings[key] = translate_repeater(mode, config)
+            except UnhandledRepeaterError, e:
+                logger.warn("Unhandled repeater %s: %s", rep, e)
+                _repeating_strings[key] = None
+        if _repeating_strings[key] is None:
+            print("Task is set to repeat, but that is not added to Todoist. "
+                  "Manual intervention is needed.")
+            raise UnhandledRepeaterError("Unhandled %s repetition" % mode)
+        return _repeating_strings[key]
 
-        # Mapping of cycles
-        cycles = ('', '', '2nd', '3rd', '4th', '5th', '6th', '7th', '8th',
-                  '9th', '10th', '11th', '12th', '13th', '14th', '15th', '16th',
-                  '17th', '18th', '19th', '20th', '21st', '22nd', '23rd',
-                  '24th', '25th', '26th', '27th', '28th', '29th', '30th')
 
-        config = rep[rep['mode']]
-        days = ''
+class QueueHandler(logging.Handler):
+    """Hand over log records to a `QueueListener`, which writes them.
 
-        if rep['mode'] == 'daily':
-            days = 'day'
-        elif rep['mode'] == 'weekly':
-            print("Task is set to repeat, but that is not added to Todoist. "
-                  "Manual intervention is needed.")
-            # TODO: Translation not fixed
-            raise UnhandledRepeaterError("Unhandled weekly repetition")
-        elif rep['mode'] == 'monthly':
-            print("Task is set to repeat, but that is not added to Todoist. "
-                  "Manual intervention is needed.")
-            # TODO: Translation not fixed
-            raise UnhandledRepeaterError("Unhandled monthly repetition")
-        elif rep['mode'] == 'yearly':
-            print("Task is set to repeat, but that is not added to Todoist. "
-                  "Manual intervention is needed.")
-            # TODO: Translation not fixed
-            raise UnhandledRepeaterError("Unhandled yearly repetition")
-        else:
-            logger.warn('Unhandled repeater mode: %s', rep['mode'])
-            print "Unhandled repeat mode for task, needs manual intervention"
-            # TODO: Translation not fixed
-            raise UnhandledRepeaterError("Unhandled repetition")
-        return 'every %s %s' % (cycles[config['cycle']], days)
+    The message is formatted right away, as its arguments could change before
+    the listener gets to it, but the rest is left to the listener. Python 2
+    doesn't have logging.handlers.QueueHandler.
+
+    """
+
+    def __init__(self, listener):
+        logging.Handler.__init__(self)
+        self.listener = listener
 
+    def emit(self, record):
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(
+                                                            record.exc_info)
+                record.exc_info = None
+            self.listener.queue.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+class QueueListener(object):
+    """Write log records from a `QueueHandler` in a background thread.
+
+    Threads don't survive a fork, so a forked process must call `start` to get
+    its records written, and `stop` to flush them.
 
-def setup_logger(debug=False):
-    """Setup the script's logger."""
-    global logger
+    """
+
+    def __init__(self, *handlers):
+        self.handlers = handlers
+        self.queue = Queue.Queue()
+        self._thread = None
+
+    def start(self):
+        """Start writing records, unless already started in this process."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self.queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        """Write what's left in the queue, and stop."""
+        if self._thread is not None and self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join()
+        self._thread = None
+
+# The listener for the logger, if logging in the background
+log_listener = None
+
+def setup_logger(debug=False, level=logging.INFO, background=False):
+    """Setup the script's logger.
+
+    :param bool debug: Log everything, to stderr as well.
+    :param int level: What to log to the file, if not debugging.
+    :param bool background: Write the log in a background thread, so the
+        export doesn't wait for the disk.
+
+    """
+    global logger, log_listener
+    if debug:
+        level = logging.DEBUG
     logger = logging.getLogger('doit2todoist')
+    # Records below the level are dropped before they're created
+    logger.setLevel(level)
+    handlers = []
     ch = logging.FileHandler('doit2todoist.log')
-    logger.setLevel(logging.DEBUG)
-    ch.setLevel(logging.DEBUG)
+    ch.setLevel(level)
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     ch.setFormatter(formatter)
-    logger.addHandler(ch)
+    handlers.append(ch)
     if debug:
         ch2 = logging.StreamHandler()
         ch2.setLevel(logging.DEBUG)
         formatter = logging.Formatter('%(asctime)s - %(levelname)s: %(message)s')
         ch2.setFormatter(formatter)
-        logger.addHandler(ch2)
+        handlers.append(ch2)
+    if background:
+        log_listener = QueueListener(*handlers)
+        log_listener.start()
+        atexit.register(log_listener.stop)
+        handlers = [QueueHandler(log_listener)]
+    for handler in handlers:
+        logger.addHandler(handler)
     return logger
 
+def export_account(exp, cache_file, resume=False):
+    """Sync with Todoist and export the Doit data to the account.
+
+    :param Todoist_exporter exp: The exporter, with the Doit data, the Todoist
+        API and the identity map.
+    :param str cache_file: Where the state of the Todoist account is cached.
+    :param bool resume: If an interrupted export should be resent first.
+        Without it, nothing is exported while there is an interrupted export,
+        as the export could skip what it left unacknowledged.
+    :rtype: int
+    :return: The exit code, 0 if all is well.
+
+    """
+    tdst = exp.tdst
+    if resume:
+        print "Resent %d commands from the interrupted export" % exp.resume()
+    elif exp.idmap.unacked():
+        print("The last export was interrupted, use --resume to continue "
+              "where it stopped")
+        return 1
+    if tdst.sync_token != '*':
+        print "Syncing changes in Todoist since last run..."
+    status = tdst.sync()
+    if 'error' in status:
+        logger.error('Failed sync with Todoist: %s', status)
+        print("Error from Todoist: %s - %s" % (status['error_code'],
+                status['error']))
+        return 1
+    tdst.save_state(cache_file)
+    print "Start syncing with Todoist..."
+    exp.export()
+    tdst.save_state(cache_file)
+    print "Sync done!"
+    return 0
+
+
+def _new_exports(directory, seen, settle):
+    """Return the Doit exports in the directory that are new or changed.
+
+    Files modified in the last `settle` seconds are left for later, as they
+    could still be written.
+
+    :param dict seen: The files already handled, with their modification time.
+    :rtype: list
+    :return: Tuples of (mtime, path), the newest last.
+
+    """
+    ret = []
+    now = time.time()
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if (not name.lower().endswith(('.json', '.html', '.htm')) or
+                not os.path.isfile(path)):
+            continue
+        mtime = os.path.getmtime(path)
+        if seen.get(path) == mtime or now - mtime < settle:
+            continue
+        ret.append((mtime, path))
+    return sorted(ret)
+
+
+def watch_directory(directory, tdst, idmap, cache_file, interval=60):
+    """Export new Doit exports from a directory, until interrupted.
+
+    The directory is checked for new or changed exports every `interval`
+    seconds. Each export is compared with what was exported last, by its
+    `usn`, and only the changes are sent to Todoist, see
+    `Todoist_exporter.since_usn`. If several exports have arrived, only the
+    newest is used, as it has all the changes.
+
+    The same Todoist session and state is used all the time, so every check
+    only needs to sync what has changed in Todoist since the last one.
+
+    An export that fails is logged, and tried again at the next check.
+
+    :rtype: int
+    :return: The exit code.
+
+    """
+    seen = {}
+    print "Watching %s for Doit exports, every %d seconds" % (directory,
+                                                              interval)
+    try:
+        while True:
+            new = _new_exports(directory, seen, min(interval, 10))
+            for mtime, path in new[:-1]:
+                logger.info("Skipping %s, as there is a newer export", path)
+                seen[path] = mtime
+            if new:
+                mtime, path = new[-1]
+                if _ingest_export(path, tdst, idmap, cache_file):
+                    seen[path] = mtime
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print "Stopped watching"
+    return 0
+
+
+def _ingest_export(path, tdst, idmap, cache_file):
+    """Export the changes in a Doit export, for `watch_directory`.
+
+    :rtype: bool
+    :return: True if the export is done, False if it should be tried again.
+
+    """
+    print "Reading %s" % path
+    with metrics.span('ingest') as span:
+        try:
+            doit = load_doit_file(path)
+        except Exception:
+            logger.exception("Could not read Doit export %s", path)
+            print "Could not read %s, see the log" % path
+            return False
+        exp = Todoist_exporter(doit, tdst, idmap, idmap.high_water_usn())
+        sent = [0]
+
+        def count(commands):
+            sent[0] += len(commands)
+        tdst.send_listeners.append(count)
+        try:
+            # What a failed try left unacknowledged is sent first
+            status = export_account(exp, cache_file, resume=True)
+        except Exception:
+            logger.exception("Export of %s failed", path)
+            status = 1
+        finally:
+            tdst.send_listeners.remove(count)
+        span['commands'] = sent[0]
+        if status != 0:
+            # What was left in the queue is planned again at the next try
+            del tdst.queue[:]
+            print "Export of %s failed, trying again at the next check" % path
+            return False
+        print "Sent %d commands to Todoist for %s" % (sent[0], path)
+        return True
+
+
+def account_filename(filename, apikey):
+    """Return a filename that is unique for the Todoist account.
+
+    E.g. doit2todoist.db becomes doit2todoist-<account>.db, where the account
+    is a digest of the API key, so the key itself is not revealed.
+
+    """
+    base, ext = os.path.splitext(filename)
+    return '%s-%s%s' % (base, hashlib.md5(apikey).hexdigest()[:12], ext)
+
+
+def read_manifest(filename):
+    """Read the Doit files and Todoist accounts to migrate.
+
+    Each line in the manifest has the path to an exported Doit file and the API
+    key of the Todoist account to export it to, separated by whitespace. Empty
+    lines and lines starting with # are ignored. Relative paths are relative to
+    the manifest.
+
+    :rtype: list
+    :return: Tuples of (apikey, list of doit files), one per account, in the
+        order they first appear in the manifest.
+
+    """
+    accounts = {}
+    order = []
+    basedir = os.path.dirname(os.path.abspath(filename))
+    with open(filename) as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = line.split()
+            if len(parts) != 2:
+                raise ValueError("%s:%d: Expected a Doit file and an API key"
+                                 % (filename, lineno))
+            doit_file, apikey = parts
+            if apikey not in accounts:
+                accounts[apikey] = []
+                order.append(apikey)
+            accounts[apikey].append(os.path.join(basedir, doit_file))
+    return [(apikey, accounts[apikey]) for apikey in order]
+
+
+def _migrate_account(job):
+    """Migrate the Doit files for one Todoist account, in a worker process.
+
+    The files are exported one by one, since they go to the same account and
+    share its rate budget and identity map. The output from the export goes to
+    a log file for the account instead of being mixed with the other workers.
+
+    :rtype: dict
+    :return: Statistics from the migration, and the error if it failed.
+
+    """
+    global metrics
+    apikey, doit_files, options = job
+    # A worker could migrate several accounts
+    metrics = Metrics()
+    if log_listener is not None:
+        log_listener.start()
+    account = hashlib.md5(apikey).hexdigest()[:12]
+    stats = {'account': account, 'files': len(doit_files), 'exported': 0,
+             'tasks': 0, 'commands': 0, 'batches': 0, 'waited': 0.0,
+             'error': None}
+    start = time.time()
+    limiter = RateLimiter(options['requests_per_minute'])
+    stdout = sys.stdout
+    sys.stdout = open(account_filename(options['log'], apikey), 'a')
+    try:
+        tdst = TodoistHelperAPI(apikey, batch_size=options['batch_size'],
+                                max_request_size=options['max_request_size'],
+                                limiter=limiter,
+                                concurrency=options['concurrency'],
+                                api_endpoint=options['api_url'])
+
+        def count(commands):
+            stats['commands'] += len(commands)
+            stats['batches'] += 1
+        tdst.send_listeners.append(count)
+        cache_file = account_filename(options['state_cache'], apikey)
+        tdst.load_state(cache_file)
+        for doit_file in doit_files:
+            print "Migrating %s" % doit_file
+            doit = load_doit_file(doit_file)
+            idmap = IdentityMap(account_filename(options['idmap'], apikey))
+            try:
+                since_usn = None
+                if options['delta']:
+                    since_usn = idmap.high_water_usn()
+                exp = Todoist_exporter(doit, tdst, idmap, since_usn)
+                if export_account(exp, cache_file, options['resume']) != 0:
+                    raise Exception("Sync with Todoist failed")
+            finally:
+                idmap.close()
+                tdst.send_listeners[:] = [count]
+                del tdst.commit_listeners[:]
+            stats['exported'] += 1
+            stats['tasks'] += len(doit.tasks)
+    except Exception, e:
+        logger.exception("Migration failed for account %s", account)
+        stats['error'] = '%s: %s' % (type(e).__name__, e)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        if log_listener is not None:
+            # The worker could exit without running atexit
+            log_listener.stop()
+    stats['waited'] = limiter.waited
+    stats['seconds'] = time.time() - start
+    stats['phases'] = metrics.summary()
+    return stats
+
+
+def migrate_manifest(manifest, processes=None, **options):
+    """Migrate all the accounts in a manifest, in parallel worker processes.
+
+    Each account is migrated by its own worker, with its own rate limiter,
+    identity map and state cache, see `account_filename`. The progress is
+    printed as the accounts are done, and a summary at the end.
+
+    :param str manifest: The manifest file, see `read_manifest`.
+    :param int processes: The number of worker processes. Default: The number
+        of CPUs.
+    :param options: The options for `_migrate_account`.
+    :rtype: list
+    :return: The statistics for each account.
+
+    """
+    accounts = read_manifest(manifest)
+    jobs = [(apikey, files, options) for apikey, files in accounts]
+    processes = min(processes or multiprocessing.cpu_count(), len(jobs)) or 1
+    print("Migrating %d files to %d Todoist accounts, in %d processes" %
+          (sum(len(files) for _, files in accounts), len(jobs), processes))
+    pool = multiprocessing.Pool(processes)
+    results = []
+    try:
+        for stats in pool.imap_unordered(_migrate_account, jobs):
+            results.append(stats)
+            if stats['error']:
+                status = 'FAILED: %s' % stats['error']
+            else:
+                status = 'done'
+            print("[%d/%d] Account %s: %d of %d files, %d tasks, %d commands "
+                  "in %.1f seconds, %s" % (len(results), len(jobs),
+                                           stats['account'],
+                                           stats['exported'], stats['files'],
+                                           stats['tasks'], stats['commands'],
+                                           stats['seconds'], status))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    failed = [r for r in results if r['error']]
+    seconds = max([r['seconds'] for r in results] or [0])
+    tasks = sum(r['tasks'] for r in results)
+    print "Migration summary:"
+    print "  Accounts:            %d (%d failed)" % (len(results), len(failed))
+    print "  Files exported:      %d" % sum(r['exported'] for r in results)
+    print "  Tasks:               %d" % tasks
+    print "  Commands sent:       %d" % sum(r['commands'] for r in results)
+    print "  Requests:            %d" % sum(r['batches'] for r in results)
+    print "  Waited for limits:   %.1f seconds" % sum(r['waited']
+                                                       for r in results)
+    if seconds:
+        print "  Tasks per second:    %.1f" % (tasks / seconds)
+    return results
+
+
 def main():
     parser = argparse.ArgumentParser(description="Import Doit.im data and "
                                                  "export it to Todoist")
-    parser.add_argument('doit_file',
+    parser.add_argument('doit_file', nargs='?',
                         help='The file with data from Doit.im, in JSON format')
-    parser.add_argument('apikey',
+    parser.add_argument('apikey', nargs='?',
                         help='Your API key for your account in Todoist')
+    parser.add_argument('--api-url', default='https://todoist.com',
+                        help="The base URL for Todoist's API, e.g. for testing "
+                             "against todoist_server.py. Default: %(default)s")
+    parser.add_argument('--log-level', default='INFO',
+                        choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'),
+                        help='What to log to doit2todoist.log. --debug sets it '
+                             'to DEBUG. Default: %(default)s')
+    parser.add_argument('--log-in-background', action='store_true',
+                        help='Write the log in a background thread, for big '
+                             'exports')
+    parser.add_argument('--log-payloads', type=float, default=0.0,
+                        metavar='SHARE',
+                        help='Share of the requests to Todoist to log in full '
+                             'at DEBUG level, from 0 to 1. The rest are only '
+                             'summarized. Default: %(default)s')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='Save timings and counts for each phase of the '
+                             'run as JSON in the file')
+    parser.add_argument('--manifest', metavar='FILE',
+                        help='Migrate several Doit files and Todoist accounts '
+                             'in parallel. Each line in the file has a Doit '
+                             'file and an API key.')
+    parser.add_argument('--processes', type=int,
+                        help='Number of worker processes for --manifest. '
+                             'Default: The number of CPUs')
     parser.add_argument('-d', '--debug', action='store_true',
                         help='Print debug information, for developers')
+    parser.add_argument('--idmap', default='doit2todoist.db',
+                        help='File for storing what Doit data that is already '
+                             'exported to Todoist, for later runs. '
+                             'Default: %(default)s')
+    parser.add_argument('--state-cache', default='doit2todoist.state',
+                        help='File for caching the state of the Todoist '
+                             'account, so later runs only need to sync what '
+                             'has changed. Default: %(default)s')
+    parser.add_argument('--requests-per-minute', type=int, default=50,
+                        help='Max number of requests to send to Todoist per '
+                             'minute. Default: %(default)s')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an interrupted export, by first sending '
+                             'what was not acknowledged by Todoist')
+    parser.add_argument('--delta', action='store_true',
+                        help='Only export what has changed in Doit since the '
+                             'last export, by its usn, and complete the tasks '
+                             'that are gone. Needs a full Doit export.')
+    parser.add_argument('--since-usn', type=int, metavar='USN',
+                        help='Like --delta, but export what has changed after '
+                             'the given usn')
+    parser.add_argument('--watch', metavar='DIR',
+                        help='Keep running, and export the changes in every '
+                             'new Doit export that is put in the directory. '
+                             'Only the API key is then needed.')
+    parser.add_argument('--interval', type=int, default=60,
+                        help='Seconds between each check of the --watch '
+                             'directory. Default: %(default)s')
+    parser.add_argument('--plan-only', action='store_true',
+                        help='Only print what would be exported, and how many '
+                             'commits it would need. Uses the cached state of '
+                             'Todoist, if any, without syncing.')
+    parser.add_argument('--save-plan', metavar='FILE',
+                        help='Save the planned export as JSON in the file')
+    parser.add_argument('--templates', metavar='DIR',
+                        help='Instead of exporting to Todoist, write a CSV '
+                             'template per project in the directory, for '
+                             "importing with Todoist's template import. No "
+                             'API key is needed.')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='Max number of batches to send to Todoist at the '
+                             'same time. Default: %(default)s')
+    parser.add_argument('--max-request-size', type=int,
+                        default=TodoistHelperAPI.max_request_size,
+                        help='Max number of bytes of commands to send to '
+                             'Todoist per request. Default: %(default)s')
+    parser.add_argument('--batch-size', type=int,
+                        default=TodoistHelperAPI.batch_size,
+                        help='Max number of commands to send to Todoist per '
+                             'request. Default: %(default)s')
     args = parser.parse_args()
 
-    setup_logger(args.debug)
+    setup_logger(args.debug, getattr(logging, args.log_level),
+                 args.log_in_background)
+    TodoistHelperAPI.payload_log_rate = args.log_payloads
+
+    if args.manifest:
+        results = migrate_manifest(args.manifest, args.processes,
+                                   idmap=args.idmap,
+                                   state_cache=args.state_cache,
+                                   log='doit2todoist.out',
+                                   requests_per_minute=args.requests_per_minute,
+                                   batch_size=args.batch_size,
+                                   max_request_size=args.max_request_size,
+                                   concurrency=args.concurrency,
+                                   resume=args.resume,
+                                   delta=args.delta,
+                                   api_url=args.api_url)
+        if args.metrics:
+            with open(args.metrics, 'w') as f:
+                json.dump({'accounts': results}, f, indent=2, sort_keys=True)
+        return 1 if any(r['error'] for r in results) else 0
+    if args.metrics:
+        atexit.register(metrics.save, args.metrics)
+    if args.watch:
+        # Only the API key is given
+        apikey = args.apikey or args.doit_file
+        if not apikey or (args.apikey and args.doit_file):
+            parser.error('Only an API key is needed with --watch')
+        tdst = TodoistHelperAPI(apikey, batch_size=args.batch_size,
+                                max_request_size=args.max_request_size,
+                                limiter=RateLimiter(args.requests_per_minute),
+                                concurrency=args.concurrency,
+                                api_endpoint=args.api_url)
+        tdst.load_state(args.state_cache)
+        idmap = IdentityMap(args.idmap)
+        try:
+            return watch_directory(args.watch, tdst, idmap, args.state_cache,
+                                   args.interval)
+        finally:
+            idmap.close()
+    if not args.doit_file or not (args.apikey or args.templates):
+        parser.error('A Doit file and an API key is needed, or --manifest')
 
-    doit_data = parse_json_file(args.doit_file)
-    doit = Doit(doit_data)
+    doit = load_doit_file(args.doit_file)
 
     print("Doit.im data read:")
     doit.print_status()
 
-    tdst = TodoistHelperAPI(args.apikey)
-    status = tdst.sync()
-    if 'error' in status:
-        logger.error('Failed sync with Todoist: %s', status)
-        print("Error from Todoist: %s - %s" % (status['error_code'],
-                status['error']))
-        return 1
-    exp = Todoist_exporter(doit, tdst)
-    print "Start syncing with Todoist..."
-    exp.export()
-    print "Sync done!"
-    return 0
+    if args.templates:
+        Todoist_exporter(doit, None).export_templates(args.templates)
+        return 0
+
+    tdst = TodoistHelperAPI(args.apikey, batch_size=args.batch_size,
+                            max_request_size=args.max_request_size,
+                            limiter=RateLimiter(args.requests_per_minute),
+                            concurrency=args.concurrency,
+                            api_endpoint=args.api_url)
+    cached = tdst.load_state(args.state_cache)
+    idmap = IdentityMap(args.idmap)
+    since_usn = args.since_usn
+    if args.delta and since_usn is None:
+        since_usn = idmap.high_water_usn()
+        if since_usn is None:
+            print "No earlier export is recorded, so everything is exported"
+    exp = Todoist_exporter(doit, tdst, idmap, since_usn)
+    if args.plan_only or args.save_plan:
+        if not cached:
+            tdst.sync()
+            tdst.save_state(args.state_cache)
+        plan = exp.plan()
+        if args.save_plan:
+            plan.save(args.save_plan)
+        if args.plan_only:
+            print "Planned export to Todoist:"
+            plan.print_status(tdst.batch_size, args.requests_per_minute)
+            idmap.close()
+            return 0
+    try:
+        return export_account(exp, args.state_cache, args.resume)
+    finally:
+        idmap.close()
 
 if __name__ == '__main__':
     sys.exit(main())
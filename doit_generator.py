@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+""" Generate synthetic Doit.im exports, for testing and benchmarking.
+
+The exports look like what Doit.im gives, either as pure JSON or still wrapped
+in the HTML page, see the README. The numbers of tasks, projects, tags and
+contexts are configurable, and so are the share of repeating tasks and the
+length of the notes. The same seed always gives the same data.
+
+To test against an account that already has some of the data, like when
+rerunning an export, `--overlap` writes a seed file with Todoist items for some
+of the tasks, for `todoist_server.py --seed`.
+
+"""
+
+import sys
+import json
+import random
+import argparse
+
+# Weights for the task attributes in Doit
+attributes = (('next', 30), ('plan', 25), ('inbox', 15), ('waiting', 10),
+              ('noplan', 20))
+
+words = ('call', 'email', 'buy', 'fix', 'write', 'read', 'plan', 'book', 'pay',
+         'clean', 'review', 'meeting', 'report', 'garden', 'car', 'bike',
+         'tickets', 'dentist', 'taxes', 'invoice', 'groceries', 'letter',
+         'presentation', 'budget', 'holiday', 'birthday', 'present', 'roof')
+
+# Milliseconds since epoch, as Doit has it
+day_ms = 24 * 3600 * 1000
+start_ms = 1420070400000
+
+
+def _weighted(rnd, choices):
+    total = sum(w for _, w in choices)
+    n = rnd.uniform(0, total)
+    for value, weight in choices:
+        n -= weight
+        if n <= 0:
+            return value
+    return choices[-1][0]
+
+
+def _text(rnd, length):
+    """Return random words of about the given length, with some line breaks."""
+    parts = []
+    size = 0
+    while size < length:
+        word = rnd.choice(words)
+        if rnd.random() < 0.05:
+            word += '\n'
+        parts.append(word)
+        size += len(word) + 1
+    return ' '.join(parts)[:length]
+
+
+def make_repeater(rnd):
+    """Return a random repeater, in Doit's format."""
+    mode = rnd.choice(('daily', 'weekly', 'monthly', 'yearly'))
+    cycle = rnd.choice((1, 1, 1, 2, 3))
+    repeater = {'mode': mode, 'ends_on': 0}
+    if mode == 'daily':
+        repeater['daily'] = {'cycle': cycle}
+    elif mode == 'weekly':
+        days = sorted(rnd.sample(range(7), rnd.randint(1, 3)))
+        repeater['weekly'] = {'cycle': cycle, 'days': days}
+    elif mode == 'monthly':
+        if rnd.random() < 0.5:
+            repeater['monthly'] = {'cycle': cycle,
+                                   'day_of_month': rnd.randint(1, 28)}
+        else:
+            repeater['monthly'] = {'cycle': cycle,
+                                   'week': {'week_of_month': rnd.randint(1, 4),
+                                            'day_of_week': rnd.randint(0, 6)}}
+    else:
+        repeater['yearly'] = {'cycle': cycle, 'month': rnd.randint(0, 11),
+                              'day_of_month': rnd.randint(1, 28)}
+    return repeater
+
+
+def generate(tasks=1000, projects=None, tags=None, contexts=None,
+             repeaters=0.05, notes=0.3, note_length=200, seed=0):
+    """Generate the data of a Doit export.
+
+    :param int tasks: Number of tasks.
+    :param int projects: Number of projects. Default: One per 20 tasks.
+    :param int tags: Number of tags. Default: One per 50 tasks, at least 3.
+    :param int contexts: Number of contexts. Default: 5.
+    :param float repeaters: Share of the tasks that repeat.
+    :param float notes: Share of the tasks that have notes.
+    :param int note_length: Mean length of the notes. Some are much longer.
+    :param seed: For the random generator.
+    :rtype: dict
+    :return: The same as the JSON in a Doit export.
+
+    """
+    rnd = random.Random(seed)
+    if projects is None:
+        projects = max(1, tasks // 20)
+    if tags is None:
+        tags = max(3, tasks // 50)
+    if contexts is None:
+        contexts = 5
+    usn = [0]
+
+    def record(**kwargs):
+        usn[0] += 1
+        updated = start_ms + rnd.randint(0, 900) * day_ms
+        kwargs.update({'usn': usn[0], 'updated': updated, 'deleted': 0,
+                       'trashed': 0, 'archived': 0, 'completed': 0,
+                       '$$hashKey': '%03x' % usn[0]})
+        return kwargs
+
+    data = {'goals': [], 'contacts': []}
+    data['contexts'] = [record(uuid='context-%d' % i, name='context%d' % i,
+                               pos=i)
+                        for i in xrange(contexts)]
+    data['tags'] = [record(uuid='tag-%d' % i, name='tag%d' % i)
+                    for i in xrange(tags)]
+    data['projects'] = []
+    for i in xrange(projects):
+        end_at = 0
+        if rnd.random() < 0.2:
+            end_at = start_ms + rnd.randint(0, 1000) * day_ms
+        data['projects'].append(record(
+            uuid='project-%d' % i, name='Project %d %s' % (i, _text(rnd, 20)),
+            status='inactive' if rnd.random() < 0.1 else 'active', pos=i,
+            start_at=0, end_at=end_at,
+            notes=_text(rnd, note_length) if rnd.random() < notes else '',
+            medias=[]))
+
+    data['tasks'] = []
+    for i in xrange(tasks):
+        attribute = _weighted(rnd, attributes)
+        task = record(id='task-%d' % i, uuid='task-uuid-%d' % i,
+                      title='%s %s #%d' % (rnd.choice(words).capitalize(),
+                                          ' '.join(_text(rnd, 30).split()), i),
+                      attribute=attribute, pos=rnd.randint(0, tasks),
+                      priority=rnd.randint(0, 3), start_at=0, end_at=0,
+                      tags=[], notes='', medias=[], reminders=[])
+        if projects and rnd.random() < 0.7:
+            task['project'] = 'project-%d' % rnd.randrange(projects)
+        if tags and rnd.random() < 0.5:
+            task['tags'] = ['tag%d' % rnd.randrange(tags)
+                            for _ in xrange(rnd.randint(1, 2))]
+        if contexts and rnd.random() < 0.6:
+            task['context'] = 'context-%d' % rnd.randrange(contexts)
+        if attribute == 'plan' or rnd.random() < 0.2:
+            task['start_at'] = start_ms + rnd.randint(0, 1000) * day_ms
+        if rnd.random() < notes:
+            length = int(rnd.expovariate(1.0 / note_length)) + 1
+            task['notes'] = _text(rnd, length)
+        if rnd.random() < repeaters:
+            task['repeater'] = make_repeater(rnd)
+            task['start_at'] = task['start_at'] or start_ms
+        if rnd.random() < 0.05:
+            task['completed'] = task['updated']
+        data['tasks'].append(task)
+    return data
+
+
+def overlap_seed(data, overlap, seed=0):
+    """Return Todoist data for an account that already has some of the tasks.
+
+    :param float overlap: Share of the active tasks to put in the account.
+    :rtype: dict
+    :return: Projects, items and labels, as in a sync response.
+
+    """
+    rnd = random.Random(seed)
+    items = [{'content': t['title'], 'project_id': 'inbox'}
+             for t in data['tasks']
+             if not t['completed'] and rnd.random() < overlap]
+    return {'items': items,
+            'labels': [{'name': t['name']} for t in data['tags']
+                       if rnd.random() < overlap]}
+
+
+def write_export(data, filename, html=False):
+    """Write the data as a Doit export, either as JSON or wrapped in HTML.
+
+    The JSON is written one task at a time, to not have the whole export in
+    memory twice.
+
+    """
+    def escape(s):
+        if html:
+            s = s.replace('&', '&amp;').replace('<', '&lt;')
+            s = s.replace('>', '&gt;')
+        return s
+
+    with open(filename, 'w') as f:
+        if html:
+            f.write('<html><head><title>Doit.im</title></head>\n'
+                    '<body class="doit">')
+        f.write('{')
+        for key in sorted(data):
+            if key == 'tasks':
+                continue
+            f.write('%s: %s, ' % (json.dumps(key),
+                                  escape(json.dumps(data[key]))))
+        f.write('"tasks": [')
+        for i, task in enumerate(data['tasks']):
+            if i:
+                f.write(', ')
+            f.write(escape(json.dumps(task)))
+        f.write(']}')
+        if html:
+            f.write('</body></html>\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic Doit.im "
+                                                 "export")
+    parser.add_argument('output', help='The file to write the export to')
+    parser.add_argument('--tasks', type=int, default=1000,
+                        help='Default: %(default)s')
+    parser.add_argument('--projects', type=int,
+                        help='Default: One per 20 tasks')
+    parser.add_argument('--tags', type=int,
+                        help='Default: One per 50 tasks, at least 3')
+    parser.add_argument('--contexts', type=int, default=5,
+                        help='Default: %(default)s')
+    parser.add_argument('--repeaters', type=float, default=0.05,
+                        help='Share of repeating tasks. Default: %(default)s')
+    parser.add_argument('--notes', type=float, default=0.3,
+                        help='Share of tasks with notes. Default: %(default)s')
+    parser.add_argument('--note-length', type=int, default=200,
+                        help='Mean length of the notes. Default: %(default)s')
+    parser.add_argument('--html', action='store_true',
+                        help='Wrap the JSON in HTML, like the page in Doit.im')
+    parser.add_argument('--overlap', type=float, default=0.0,
+                        help='Share of the tasks that the Todoist account '
+                             'already has, see --seed-file')
+    parser.add_argument('--seed-file',
+                        help='Where to write the existing Todoist data, for '
+                             'todoist_server.py --seed')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the random generator')
+    args = parser.parse_args()
+
+    data = generate(args.tasks, args.projects, args.tags, args.contexts,
+                    args.repeaters, args.notes, args.note_length, args.seed)
+    write_export(data, args.output, args.html)
+    print "Wrote %d tasks and %d projects to %s" % (len(data['tasks']),
+                                                   len(data['projects']),
+                                                   args.output)
+    if args.seed_file:
+        with open(args.seed_file, 'w') as f:
+            json.dump(overlap_seed(data, args.overlap, args.seed), f)
+        print "Wrote the existing Todoist data to %s" % args.seed_file
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+""" Tests of doit2todoist against the stand-in server in todoist_server.py.
+
+The server only resolves temp_ids within the request that created them, like
+Todoist, so commands that are sent in a later batch must have their real ids.
+
+Run with:
+
+    python -m unittest test_doit2todoist
+
+"""
+
+import logging
+import threading
+import unittest
+
+import doit2todoist
+import todoist_server
+
+
+def setUpModule():
+    # Without setup_logger, so no log file is written
+    doit2todoist.logger = logging.getLogger('doit2todoist')
+
+
+class ItemMoveTest(unittest.TestCase):
+    """Moving items into projects that are created in the same export."""
+
+    def setUp(self):
+        self.server = todoist_server.TodoistServer(('127.0.0.1', 0))
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def api(self, **kwargs):
+        api = doit2todoist.TodoistHelperAPI(
+                    'token', api_endpoint=self.url,
+                    limiter=doit2todoist.RateLimiter(60000), **kwargs)
+        api.sync()
+        return api
+
+    def queue_move(self, api):
+        """Queue an item in the Inbox, and its move to a new project.
+
+        :rtype: tuple
+        :return: The item and the project
+
+        """
+        item = api.add_inbox_item('Task')
+        api.commit()
+        project = api.add_project('New project')
+        api.move_item(item, project['id'])
+        return item, project
+
+    def assert_moved(self, api, item, project):
+        account = self.server.accounts['token']
+        self.assertEqual(account.objects['items'][api.real_id(item['id'])]
+                         ['project_id'], api.real_id(project['id']))
+
+    def test_move_in_later_batch(self):
+        api = self.api(batch_size=1)
+        item, project = self.queue_move(api)
+        api.commit()
+        self.assert_moved(api, item, project)
+
+    def test_move_after_project_level(self):
+        api = self.api(batch_size=1, concurrency=2)
+        item, project = self.queue_move(api)
+        levels = api._dependency_levels(api.queue)
+        self.assertEqual([[c['type'] for c in l] for l in levels],
+                         [['project_add'], ['item_move']])
+        api.commit()
+        self.assert_moved(api, item, project)
+
+
+if __name__ == '__main__':
+    unittest.main()
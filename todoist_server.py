@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+""" A local stand-in for Todoist's sync API, for testing doit2todoist offline.
+
+Emulates the parts of the v7 sync endpoint that doit2todoist uses: full and
+incremental syncs with a sync_token and resource_types, and commands for adding
+and updating projects, labels, items and notes, with temp_id mapping and error
+rows in sync_status. As in Todoist, a temp_id could only be used in the same
+request as the command that created it. Each API token gets its own account,
+starting with only an Inbox.
+
+To be more like the real thing, or worse, it could slow down the responses,
+answer with LIMITS_REACHED and reject too big requests. Run it and point
+doit2todoist at it:
+
+    python todoist_server.py --port 8000 --latency 0.2
+    python doit2todoist.py --api-url http://localhost:8000 doit.json sometoken
+
+GET /stats returns the number of requests, commands and errors so far.
+
+"""
+
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import urlparse
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+
+class CommandError(Exception):
+    """A command that Todoist would reject, reported in sync_status."""
+
+    def __init__(self, code, msg):
+        super(CommandError, self).__init__(msg)
+        self.code = code
+
+    def to_dict(self):
+        return {'error_code': self.code, 'error': str(self)}
+
+
+class Account(object):
+    """The data in a Todoist account, and how commands change it.
+
+    Every change gets a sequence number, which is also the sync_token. An
+    incremental sync returns what has changed since the given token.
+
+    """
+
+    # Where the objects are in the sync response
+    kinds = ('projects', 'items', 'labels', 'notes', 'project_notes')
+
+    def __init__(self, token, seed=None):
+        self.token = token
+        self.seq = 0
+        self.next_id = 1000
+        self.objects = dict((kind, {}) for kind in self.kinds)
+        # What was changed, as (kind, id), by seq - 1
+        self.changes = []
+        # The temp ids of the request that is run. Todoist doesn't know them
+        # in later requests.
+        self.temp_ids = {}
+        # The result for every command uuid, so that resent commands are not
+        # applied twice, and the id of what they created
+        self.results = {}
+        self.created = {}
+        inbox = self._create('projects', {'name': 'Inbox', 'inbox_project':
+                                          True, 'item_order': 0})
+        self.user = {'id': 1, 'token': token, 'full_name': 'Test user',
+                     'inbox_project': inbox['id']}
+        if seed:
+            self.load_seed(seed)
+
+    def load_seed(self, seed):
+        """Add existing data to the account.
+
+        :param dict seed: Lists of projects, labels and items, as in a sync
+            response but without ids. Items with project_id "inbox" are put in
+            the Inbox. See doit_generator.py.
+
+        """
+        for kind in ('projects', 'labels', 'items'):
+            for data in seed.get(kind, ()):
+                data = dict(data)
+                if data.get('project_id') == 'inbox':
+                    data['project_id'] = self.user['inbox_project']
+                self._create(kind, data)
+
+    def _touch(self, kind, obj):
+        self.seq += 1
+        self.changes.append((kind, obj['id']))
+
+    def _create(self, kind, data):
+        self.next_id += 1
+        obj = {'id': self.next_id, 'is_deleted': 0}
+        if kind in ('projects', 'items'):
+            obj.update({'indent': 1, 'item_order': 1, 'collapsed': 0,
+                        'is_archived': 0})
+        if kind == 'items':
+            obj.update({'checked': 0, 'in_history': 0, 'priority': 1,
+                        'labels': [], 'date_string': None,
+                        'due_date_utc': None})
+        obj.update(data)
+        obj['id'] = self.next_id
+        self.objects[kind][obj['id']] = obj
+        self._touch(kind, obj)
+        return obj
+
+    def _id(self, value):
+        """Return the real id for an id or temp_id."""
+        if isinstance(value, basestring) and not value.isdigit():
+            if value not in self.temp_ids:
+                raise CommandError(15, 'Invalid temporary id')
+            return self.temp_ids[value]
+        return int(value)
+
+    def _get(self, kind, value):
+        obj = self.objects[kind].get(self._id(value))
+        if obj is None or obj['is_deleted']:
+            raise CommandError(22, '%s not found' % kind[:-1].capitalize())
+        return obj
+
+    def _update(self, kind, args, fields=None):
+        obj = self._get(kind, args['id'])
+        for key, value in args.iteritems():
+            if key == 'id' or (fields and key not in fields):
+                continue
+            obj[key] = self._resolve(key, value)
+        self._touch(kind, obj)
+        return obj
+
+    def _resolve(self, key, value):
+        """Replace temp ids in the references of an argument."""
+        if value is None:
+            return value
+        if key in ('project_id', 'item_id', 'parent_id'):
+            return self._id(value)
+        if key == 'labels':
+            return [self._id(l) for l in value]
+        return value
+
+    def _args(self, args):
+        return dict((k, self._resolve(k, v)) for k, v in args.iteritems())
+
+    def project_add(self, args):
+        if not args.get('name'):
+            raise CommandError(19, 'Project name is empty')
+        return self._create('projects', self._args(args))
+
+    def project_update(self, args):
+        return self._update('projects', args)
+
+    def project_archive(self, args):
+        project = self._get('projects', args['id'])
+        project['is_archived'] = 1
+        self._touch('projects', project)
+
+    def label_add(self, args):
+        if not args.get('name'):
+            raise CommandError(19, 'Label name is empty')
+        return self._create('labels', self._args(args))
+
+    def item_add(self, args):
+        args = self._args(args)
+        args.setdefault('project_id', self.user['inbox_project'])
+        self._get('projects', args['project_id'])
+        for label in args.get('labels') or ():
+            self._get('labels', label)
+        return self._create('items', args)
+
+    def item_update(self, args):
+        return self._update('items', args)
+
+    def item_move(self, args):
+        to_project = self._get('projects', args['to_project'])
+        for ids in args['project_items'].itervalues():
+            for item_id in ids:
+                item = self._get('items', item_id)
+                item['project_id'] = to_project['id']
+                self._touch('items', item)
+
+    def _check(self, args, checked):
+        for item_id in args['ids']:
+            item = self._get('items', item_id)
+            item['checked'] = checked
+            item['in_history'] = checked
+            self._touch('items', item)
+
+    def item_close(self, args):
+        self._check({'ids': [args['id']]}, 1)
+
+    def item_complete(self, args):
+        self._check(args, 1)
+
+    def item_uncomplete(self, args):
+        self._check(args, 0)
+
+    def note_add(self, args):
+        args = self._args(args)
+        if args.get('item_id'):
+            self._get('items', args['item_id'])
+            return self._create('notes', args)
+        self._get('projects', args.get('project_id'))
+        return self._create('project_notes', args)
+
+    def note_update(self, args):
+        try:
+            return self._update('notes', args, ('content',))
+        except CommandError:
+            return self._update('project_notes', args, ('content',))
+
+    commands = ('project_add', 'project_update', 'project_archive',
+                'label_add', 'item_add', 'item_update', 'item_move',
+                'item_close', 'item_complete', 'item_uncomplete', 'note_add',
+                'note_update')
+
+    def run(self, cmd, temp_id_mapping, fail=False):
+        """Apply a command, and return its sync_status."""
+        if cmd.get('uuid') in self.results:
+            result = self.results[cmd['uuid']]
+            if cmd.get('temp_id') and cmd['uuid'] in self.created:
+                temp_id_mapping[cmd['temp_id']] = self.created[cmd['uuid']]
+            return result
+        try:
+            if fail:
+                raise CommandError(1, 'Injected error')
+            if cmd.get('type') not in self.commands:
+                raise CommandError(2, 'Unknown command: %s' % cmd.get('type'))
+            try:
+                obj = getattr(self, cmd['type'])(cmd.get('args') or {})
+            except (KeyError, TypeError, ValueError), e:
+                raise CommandError(3, 'Invalid argument: %s' % e)
+        except CommandError, e:
+            # Failed commands could be retried with the same uuid
+            return e.to_dict()
+        if cmd.get('temp_id') and obj is not None:
+            temp_id_mapping[cmd['temp_id']] = obj['id']
+            self.created[cmd.get('uuid')] = obj['id']
+        self.results[cmd.get('uuid')] = 'ok'
+        return 'ok'
+
+    def sync(self, sync_token, commands, error_probability=0.0,
+             resource_types=('all',)):
+        """Run the commands and return what has changed since sync_token.
+
+        :param resource_types: The kinds of objects to return, and "user", or
+            "all" for everything.
+
+        """
+        since = 0 if sync_token in (None, '', '*') else int(sync_token)
+        response = {'temp_id_mapping': {}, 'sync_status': {},
+                    'full_sync': since == 0}
+        self.temp_ids = response['temp_id_mapping']
+        try:
+            for cmd in commands:
+                fail = random.random() < error_probability
+                response['sync_status'][cmd.get('uuid')] = self.run(
+                                    cmd, response['temp_id_mapping'], fail)
+        finally:
+            self.temp_ids = {}
+        if 'all' in resource_types:
+            kinds = self.kinds
+        else:
+            kinds = [kind for kind in self.kinds if kind in resource_types]
+        for kind in kinds:
+            response[kind] = []
+        if since:
+            for kind, obj_id in set(self.changes[since:]):
+                if kind in response:
+                    response[kind].append(self.objects[kind][obj_id])
+        else:
+            for kind in kinds:
+                response[kind] = [obj for obj in
+                                  self.objects[kind].itervalues()
+                                  if not obj['is_deleted']]
+        if since == 0 and ('all' in resource_types or
+                           'user' in resource_types):
+            response['user'] = self.user
+        response['sync_token'] = str(self.seq)
+        return response
+
+
+class TodoistServer(ThreadingMixIn, HTTPServer):
+    """Serves the accounts, with the configured latency and limits."""
+
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, jitter=0.0,
+                 requests_per_minute=None, limit_probability=0.0,
+                 error_probability=0.0, max_commands=100,
+                 max_request_size=1024 * 1024, seed=None):
+        HTTPServer.__init__(self, address, SyncHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.requests_per_minute = requests_per_minute
+        self.limit_probability = limit_probability
+        self.error_probability = error_probability
+        self.max_commands = max_commands
+        self.max_request_size = max_request_size
+        # What new accounts should already have
+        self.seed = seed
+        self.accounts = {}
+        # The time of recent requests, per token
+        self.recent = {}
+        self.stats = {'requests': 0, 'commands': 0, 'limits_reached': 0,
+                      'rejected': 0, 'command_errors': 0, 'bytes': 0}
+        self.lock = threading.Lock()
+        self.verbose = False
+
+    def limits_reached(self, token):
+        """Tell if the request should be answered with LIMITS_REACHED."""
+        if random.random() < self.limit_probability:
+            return True
+        if not self.requests_per_minute:
+            return False
+        now = time.time()
+        recent = [t for t in self.recent.get(token, ()) if t > now - 60]
+        self.recent[token] = recent
+        if len(recent) >= self.requests_per_minute:
+            return True
+        recent.append(now)
+        return False
+
+    def sync(self, form, size):
+        """Handle a sync request, and return the HTTP code and response."""
+        token = form.get('token')
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['bytes'] += size
+            if not token:
+                return 401, {'error_code': 401, 'error_tag': 'AUTH_INVALID_TOKEN',
+                             'error': 'Invalid token'}
+            if size > self.max_request_size:
+                self.stats['rejected'] += 1
+                return 413, {'error_code': 413, 'error_tag': 'TOO_BIG',
+                             'error': 'Request is too big'}
+            if self.limits_reached(token):
+                self.stats['limits_reached'] += 1
+                return 429, {'error_code': 35, 'error_tag': 'LIMITS_REACHED',
+                             'error': 'Too many requests', 'http_code': 429,
+                             'error_extra': {'retry_after': 1}}
+            try:
+                commands = json.loads(form.get('commands') or '[]')
+                resource_types = json.loads(form.get('resource_types') or
+                                            '["all"]')
+            except ValueError:
+                self.stats['rejected'] += 1
+                return 400, {'error_code': 400,
+                             'error': 'Invalid commands or resource_types'}
+            if len(commands) > self.max_commands:
+                self.stats['rejected'] += 1
+                return 400, {'error_code': 38, 'error_tag': 'TOO_MANY_COMMANDS',
+                             'error': 'Too many commands'}
+            if token not in self.accounts:
+                self.accounts[token] = Account(token, self.seed)
+            self.stats['commands'] += len(commands)
+            response = self.accounts[token].sync(form.get('sync_token'),
+                                                 commands,
+                                                 self.error_probability,
+                                                 resource_types)
+            self.stats['command_errors'] += sum(
+                1 for status in response['sync_status'].itervalues()
+                if status != 'ok')
+            return 200, response
+
+
+class SyncHandler(BaseHTTPRequestHandler):
+    """The HTTP end of the server."""
+
+    def _reply(self, code, data):
+        body = json.dumps(data)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/stats':
+            with self.server.lock:
+                return self._reply(200, dict(self.server.stats))
+        self._reply(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/sync'):
+            return self._reply(404, {'error': 'Not found'})
+        size = int(self.headers.get('Content-Length') or 0)
+        form = dict((k, v[-1]) for k, v in
+                    urlparse.parse_qs(self.rfile.read(size)).iteritems())
+        delay = self.server.latency + random.uniform(0, self.server.jitter)
+        if delay:
+            time.sleep(delay)
+        self._reply(*self.server.sync(form, size))
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local stand-in for "
+                                                 "Todoist's sync API")
+    parser.add_argument('--host', default='localhost',
+                        help='Default: %(default)s')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='Default: %(default)s')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds to wait before every response')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Max random seconds to add to the latency')
+    parser.add_argument('--requests-per-minute', type=int,
+                        help='Answer LIMITS_REACHED when an account sends '
+                             'more requests than this')
+    parser.add_argument('--limit-probability', type=float, default=0.0,
+                        help='Probability for answering LIMITS_REACHED to any '
+                             'request')
+    parser.add_argument('--error-probability', type=float, default=0.0,
+                        help='Probability for failing any command')
+    parser.add_argument('--max-commands', type=int, default=100,
+                        help='Max commands per request. Default: %(default)s')
+    parser.add_argument('--max-request-size', type=int, default=1024 * 1024,
+                        help='Max bytes per request. Default: %(default)s')
+    parser.add_argument('--seed', metavar='FILE',
+                        help='JSON file with data that every account should '
+                             'start with, see doit_generator.py')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Log every request')
+    args = parser.parse_args()
+
+    seed = None
+    if args.seed:
+        with open(args.seed) as f:
+            seed = json.load(f)
+    server = TodoistServer((args.host, args.port), latency=args.latency,
+                           jitter=args.jitter,
+                           requests_per_minute=args.requests_per_minute,
+                           limit_probability=args.limit_probability,
+                           error_probability=args.error_probability,
+                           max_commands=args.max_commands,
+                           max_request_size=args.max_request_size,
+                           seed=seed)
+    server.verbose = args.verbose
+    print "Serving Todoist's sync API on http://%s:%d" % server.server_address
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print "Stats: %s" % json.dumps(server.stats, sort_keys=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())